@@ -0,0 +1,149 @@
+import heapq
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+from typing import Union
+
+from at_krl.core.kb_rule import KBRule
+
+from at_solver.core.goals import GoalTreeMap
+from at_solver.core.references import reference_key
+
+
+class AGENDA_STRATEGY:
+    first = "first"
+    priority = "priority"
+    specificity = "specificity"
+    recency = "recency"
+    lex = "lex"
+    mea = "mea"
+
+    @classmethod
+    def all(cls) -> List[str]:
+        return [cls.first, cls.priority, cls.specificity, cls.recency, cls.lex, cls.mea]
+
+
+class Agenda:
+    """Conflict set of activated rules ordered by the conflict-resolution strategy.
+
+    Activations are kept in a heap between steps: the matcher activates a rule when its condition becomes
+    applicable and deactivates it otherwise. Removed activations are dropped lazily. Every order key ends with
+    the rule ordinal, so equal keys fall back to the order of rules in the knowledge base.
+
+    Strategies:
+        * ``first`` - order of rules in the knowledge base;
+        * ``priority`` - rules with greater priority (salience) from ``priorities`` first;
+        * ``specificity`` - rules with more condition references first;
+        * ``recency`` - rules referencing the most recently changed fact first;
+        * ``lex`` - OPS5 LEX: recencies of all referenced facts compared in descending order, then specificity;
+        * ``mea`` - OPS5 MEA: recency of the first referenced fact, then LEX.
+    """
+
+    goal_tree: GoalTreeMap
+    strategy: str
+    priorities: Dict[str, Union[int, float]]
+    _condition_keys: List[List[str]]
+    _ticks: Dict[str, int]
+    _tick: int
+    _heap: List[Tuple]
+    _active: Dict[int, Tuple]
+
+    def __init__(
+        self, goal_tree: GoalTreeMap, strategy: str = None, priorities: Dict[str, Union[int, float]] = None
+    ) -> None:
+        strategy = strategy or AGENDA_STRATEGY.first
+        if strategy not in AGENDA_STRATEGY.all():
+            raise ValueError(f'Invalid agenda strategy "{strategy}"')
+        self.goal_tree = goal_tree
+        self.strategy = strategy
+        self.priorities = priorities or {}
+        self._condition_keys = [
+            [reference_key(ref) for ref in goal_tree.get_rule_condition_references(rule)] for rule in goal_tree.rules
+        ]
+        self._tick = 0
+        self.clear()
+
+    def clear(self):
+        self._ticks = {}
+        self._heap = []
+        self._active = {}
+
+    def touch(self, key: str):
+        self._tick += 1
+        self._ticks[key] = self._tick
+
+    def copy_recency(self, agenda: "Agenda"):
+        """Takes the recencies of facts from the agenda this one replaces."""
+        self._ticks = dict(agenda._ticks)
+        self._tick = agenda._tick
+
+    def order_key(self, ordinal: int) -> Tuple:
+        if self.strategy == AGENDA_STRATEGY.first:
+            return (ordinal,)
+        if self.strategy == AGENDA_STRATEGY.priority:
+            return (-self.priorities.get(self.goal_tree.rules[ordinal].id, 0), ordinal)
+
+        keys = self._condition_keys[ordinal]
+        if self.strategy == AGENDA_STRATEGY.specificity:
+            return (-len(keys), ordinal)
+
+        recencies = [self._ticks.get(key, 0) for key in keys]
+        if self.strategy == AGENDA_STRATEGY.recency:
+            return (-max(recencies, default=0), ordinal)
+
+        # the trailing 1 makes a longer list of recencies win over its own prefix
+        lex = tuple(sorted(-r for r in recencies)) + (1,)
+        if self.strategy == AGENDA_STRATEGY.lex:
+            return (lex, -len(keys), ordinal)
+        return (-(recencies[0] if recencies else 0), lex, -len(keys), ordinal)
+
+    def activate(self, ordinal: int):
+        key = self.order_key(ordinal)
+        if self._active.get(ordinal) == key:
+            return
+        self._active[ordinal] = key
+        heapq.heappush(self._heap, (key, ordinal))
+        self._compact()
+
+    def deactivate(self, ordinal: int):
+        if self._active.pop(ordinal, None) is not None:
+            self._compact()
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._active) + 16:
+            self._heap = [(key, ordinal) for ordinal, key in self._active.items()]
+            heapq.heapify(self._heap)
+
+    def is_active(self, ordinal: int) -> bool:
+        return ordinal in self._active
+
+    def _is_stale(self, entry: Tuple) -> bool:
+        key, ordinal = entry
+        return self._active.get(ordinal) != key
+
+    def ordered(self) -> Iterator[int]:
+        """Ordinals of active rules, best first.
+
+        Stale entries are popped from the top of the heap and the rest of the heap is walked lazily in order,
+        so taking the first rules costs O(k log k) for k taken entries. The agenda must not be changed while
+        the iterator is consumed.
+        """
+        heap = self._heap
+        while heap and self._is_stale(heap[0]):
+            heapq.heappop(heap)
+        if not heap:
+            return
+        seen = set()
+        frontier = [(heap[0], 0)]
+        while frontier:
+            entry, index = heapq.heappop(frontier)
+            if entry[1] not in seen and not self._is_stale(entry):
+                seen.add(entry[1])
+                yield entry[1]
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def sort(self, rules: List[KBRule]) -> List[KBRule]:
+        return sorted(rules, key=lambda rule: self.order_key(self.goal_tree.get_rule_ordinal(rule)))
@@ -1,9 +1,12 @@
 import inspect
 import logging
+import time
 from typing import Awaitable
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import TypedDict
 from typing import Union
 from uuid import UUID
@@ -19,12 +22,17 @@ from at_queue.core.at_component import ATComponent
 from at_queue.core.session import ConnectionParameters
 from at_queue.utils.decorators import authorized_method
 
+from at_solver.core.agenda import AGENDA_STRATEGY
 from at_solver.core.goals import Goal
 from at_solver.core.solver import Solver
+from at_solver.core.solver import SOLVER_EVALUATOR
 from at_solver.core.solver import SOLVER_MODE
 from at_solver.core.trace import Trace
+from at_solver.core.trace import TRACE_LEVEL
 from at_solver.core.wm import KBValueDict
+from at_solver.core.wm import WMUpdate
 from at_solver.core.wm import WorkingMemory
+from at_solver.evaluations.non_factor import NonFactorCalculus
 
 
 logger = logging.getLogger(__name__)
@@ -78,12 +86,32 @@ class RunResultDict(TypedDict):
     trace: TraceDict
 
 
+class BBItemsSinceDict(TypedDict):
+    revision: Union[int, str]
+    items: List[WMItemDict]
+    # references of the items removed since the requested revision, a blackboard which does not track removals
+    # must answer with a full list of items
+    removed: List[str]
+    full: bool
+
+
+# parts of error messages of a component which does not have the called method
+METHOD_NOT_FOUND_MARKERS = ["not found", "no method", "has no attribute", "unknown method", "does not exist"]
+
+
 class ATSolver(ATComponent):
     solvers: Dict[str | int, Solver]
+    # seconds a positive check of an external component is trusted. Nothing tells the solver when a component
+    # registers again, so a restarted or reconfigured component is only noticed when its cached status expires,
+    # when a call to it fails or when any check finds it not registered
+    external_status_ttl: float
+    _external_status: Dict[Tuple[str, str, Optional[str]], float]
 
-    def __init__(self, connection_parameters: ConnectionParameters, *args, **kwargs):
+    def __init__(self, connection_parameters: ConnectionParameters, *args, external_status_ttl: float = 30, **kwargs):
         super().__init__(connection_parameters, *args, **kwargs)
         self.solvers = {}
+        self.external_status_ttl = external_status_ttl
+        self._external_status = {}
 
     async def get_kb_from_config(self, config: ATComponentConfig) -> KnowledgeBase:
         kb_item = config.items.get("kb")
@@ -113,20 +141,123 @@ class ATSolver(ATComponent):
             mode = mode_item.data
             if inspect.iscoroutine(mode):
                 mode = await mode
+        strategy_item = config.items.get("strategy")
+        strategy = AGENDA_STRATEGY.first
+        if strategy_item is not None:
+            strategy = strategy_item.data
+            if inspect.iscoroutine(strategy):
+                strategy = await strategy
+        priorities_item = config.items.get("priorities")
+        priorities = None
+        if priorities_item is not None:
+            priorities = priorities_item.data
+            if inspect.iscoroutine(priorities):
+                priorities = await priorities
+        trace_level_item = config.items.get("trace_level")
+        trace_level = TRACE_LEVEL.full
+        if trace_level_item is not None:
+            trace_level = trace_level_item.data
+            if inspect.iscoroutine(trace_level):
+                trace_level = await trace_level
+        non_factor_item = config.items.get("non_factor")
+        non_factor = None
+        if non_factor_item is not None:
+            non_factor = non_factor_item.data
+            if inspect.iscoroutine(non_factor):
+                non_factor = await non_factor
+        evaluator_item = config.items.get("evaluator")
+        evaluator = SOLVER_EVALUATOR.basic
+        if evaluator_item is not None:
+            evaluator = evaluator_item.data
+            if inspect.iscoroutine(evaluator):
+                evaluator = await evaluator
+        prefetch_concurrency_item = config.items.get("prefetch_concurrency")
+        prefetch_concurrency = 0
+        if prefetch_concurrency_item is not None:
+            prefetch_concurrency = prefetch_concurrency_item.data
+            if inspect.iscoroutine(prefetch_concurrency):
+                prefetch_concurrency = await prefetch_concurrency
+        goal_slicing_item = config.items.get("goal_slicing")
+        goal_slicing = True
+        if goal_slicing_item is not None:
+            goal_slicing = goal_slicing_item.data
+            if inspect.iscoroutine(goal_slicing):
+                goal_slicing = await goal_slicing
+        stratified_item = config.items.get("stratified")
+        stratified = False
+        if stratified_item is not None:
+            stratified = stratified_item.data
+            if inspect.iscoroutine(stratified):
+                stratified = await stratified
         goals_item = config.items.get("goals")
         goals = []
         if goals_item is not None:
             goals = goals_item.data
-        return await self.create_solver(kb, mode, goals, auth_token)
+        return await self.create_solver(
+            kb,
+            mode,
+            goals,
+            auth_token,
+            strategy=strategy,
+            priorities=priorities,
+            trace_level=trace_level,
+            non_factor=non_factor,
+            evaluator=evaluator,
+            prefetch_concurrency=prefetch_concurrency,
+            goal_slicing=goal_slicing,
+            stratified=stratified,
+        )
 
     async def create_solver(
-        self, kb: KnowledgeBase, mode: str = None, goals: List[str] = None, auth_token: str = None
+        self,
+        kb: KnowledgeBase,
+        mode: str = None,
+        goals: List[str] = None,
+        auth_token: str = None,
+        strategy: str = None,
+        priorities: Dict[str, Union[int, float]] = None,
+        trace_level: str = None,
+        non_factor: Dict[str, str] = None,
+        evaluator: str = None,
+        prefetch_concurrency: int = 0,
+        goal_slicing: bool = True,
+        stratified: bool = False,
     ) -> bool:
+        """``non_factor`` turns on non-factor propagation, for example ``{"logic": "product", "combine": "max"}``.
+
+        With ``goal_slicing`` (default) and goals set, only the rules which can contribute to the goals are matched.
+        With ``stratified`` forward runs evaluate the rules in one pass over the rule strata.
+        With ``prefetch_concurrency`` above 0 backward runs request all leaves the rules leading to the current goal
+        read, which can include values serial chaining would not ask for when one of them already fails the rule.
+        """
         mode = mode or SOLVER_MODE.forwards
+        strategy = strategy or AGENDA_STRATEGY.first
+        trace_level = trace_level or TRACE_LEVEL.full
+        evaluator = evaluator or SOLVER_EVALUATOR.basic
 
         if mode not in [SOLVER_MODE.forwards, SOLVER_MODE.backwards, SOLVER_MODE.mixed]:
             raise ValueError(f'Invalid solver mode "{mode}"')
 
+        if strategy not in AGENDA_STRATEGY.all():
+            raise ValueError(f'Invalid agenda strategy "{strategy}"')
+
+        if trace_level not in TRACE_LEVEL.all():
+            raise ValueError(f'Invalid trace level "{trace_level}"')
+
+        if evaluator not in SOLVER_EVALUATOR.all():
+            raise ValueError(f'Invalid evaluator "{evaluator}"')
+
+        prefetch_concurrency = prefetch_concurrency or 0
+        if not isinstance(prefetch_concurrency, int) or prefetch_concurrency < 0:
+            raise ValueError(f'Invalid prefetch concurrency "{prefetch_concurrency}"')
+
+        if non_factor and evaluator == SOLVER_EVALUATOR.fuzzy:
+            raise ValueError("Non-factor propagation is not supported by the fuzzy evaluator")
+
+        non_factors = None
+        if non_factor:
+            non_factors = NonFactorCalculus(logic=non_factor.get("logic"), combine=non_factor.get("combine"))
+
         auth_token = auth_token or "default"
 
         knowledge_base = kb
@@ -140,28 +271,99 @@ class ATSolver(ATComponent):
 
         for goal_ref in goals:
             parsed_goals.append(Goal(KBReference.parse(goal_ref)))
-        solver = Solver(knowledge_base, mode=mode, goals=parsed_goals)
+        solver = Solver(
+            knowledge_base,
+            mode=mode,
+            goals=parsed_goals,
+            strategy=strategy,
+            priorities=priorities,
+            trace_level=trace_level,
+            non_factors=non_factors,
+            evaluator=evaluator,
+            prefetch_concurrency=prefetch_concurrency,
+            goal_slicing=goal_slicing,
+            stratified=stratified,
+        )
+
+        for cycle in solver.wm.value_cycles:
+            logger.warning(f"Default values of properties {', '.join(cycle)} depend on each other")
 
         solver.on_request_value = self.on_request_value(auth_token)
 
         auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
         self.solvers[auth_token_or_user_id] = solver
+        # the session is configured again, so the components it uses are checked again
+        self.invalidate_external_status(auth_token=auth_token)
         return True
 
+    async def get_external_status(
+        self, check: str, component: str, auth_token: Optional[str], get_status: Callable[[], Awaitable[bool]]
+    ) -> bool:
+        """Result of the external check, positive results are cached for ``external_status_ttl`` seconds.
+
+        A component found not registered loses all its cached statuses, for every token.
+        """
+        key = (check, component, auth_token)
+        expires = self._external_status.get(key)
+        if expires is not None and expires > time.monotonic():
+            return True
+        status = await get_status()
+        if status:
+            self._external_status[key] = time.monotonic() + self.external_status_ttl
+        elif check == "registered":
+            self.invalidate_external_status(component)
+        else:
+            self._external_status.pop(key, None)
+        return status
+
+    async def check_external_registered_cached(self, component: str) -> bool:
+        def get_status():
+            return self.check_external_registered(component)
+
+        return await self.get_external_status("registered", component, None, get_status)
+
+    async def check_external_configured_cached(self, component: str, auth_token: str = None) -> bool:
+        def get_status():
+            return self.check_external_configured(component, auth_token=auth_token)
+
+        return await self.get_external_status("configured", component, auth_token, get_status)
+
+    def invalidate_external_status(self, component: str = None, auth_token: str = None) -> None:
+        """Forgets cached statuses of the component (or of all components) for the token and without a token.
+
+        Called when a solver is configured, when a call to an external component fails and when a component is
+        found not registered.
+        """
+        for key in list(self._external_status):
+            _, key_component, key_auth_token = key
+            if component is not None and key_component != component:
+                continue
+            if auth_token is not None and key_auth_token not in (None, auth_token):
+                continue
+            del self._external_status[key]
+
     def on_request_value(self, auth_token: str) -> Awaitable:
         async def request_value(ref: str):
-            if await self.check_external_registered("ATDialoger") and await self.check_external_registered(
-                "ATBlackBoard"
-            ):
-                if await self.check_external_configured("ATDialoger", auth_token=auth_token):
-                    await self.exec_external_method("ATDialoger", "request_value", {"ref": ref}, auth_token=auth_token)
-                    v = await self.exec_external_method("ATBlackBoard", "get_item", {"ref": ref}, auth_token=auth_token)
+            dialoger_registered = await self.check_external_registered_cached("ATDialoger")
+            if dialoger_registered and await self.check_external_registered_cached("ATBlackBoard"):
+                if await self.check_external_configured_cached("ATDialoger", auth_token=auth_token):
+                    try:
+                        await self.exec_external_method(
+                            "ATDialoger", "request_value", {"ref": ref}, auth_token=auth_token
+                        )
+                        v = await self.exec_external_method(
+                            "ATBlackBoard", "get_item", {"ref": ref}, auth_token=auth_token
+                        )
+                    except Exception:
+                        self.invalidate_external_status("ATDialoger", auth_token=auth_token)
+                        self.invalidate_external_status("ATBlackBoard", auth_token=auth_token)
+                        raise
                     value = KBValue(
                         content=v.get("value"),
                         non_factor=NonFactor(
-                            belief=v.get("belief"),
-                            probability=v.get("probability"),
-                            accuracy=v.get("accuracy"),
+                            belief=v.get("belief", 50) or 50,
+                            probability=v.get("probability", 100) or 100,
+                            accuracy=v.get("accuracy", 0) or 0,
                         ),
                     )
                     solver = self.get_solver(auth_token)
@@ -207,25 +409,86 @@ class ATSolver(ATComponent):
         solver.set_goals(parsed_goals)
         return True
 
-    @authorized_method
-    async def update_wm(self, items: List[WMItemDict], clear_before: bool = True, auth_token: str = None) -> bool:
-        auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
-        solver = self.get_solver(auth_token_or_user_id=auth_token_or_user_id)
-        if clear_before:
-            solver.wm = WorkingMemory(kb=solver.kb)
-        for item in items:
-            nf = NonFactor(
+    @staticmethod
+    def get_wm_updates(items: List[WMItemDict]) -> List[WMUpdate]:
+        return [
+            WMUpdate(
+                path=item["ref"],
+                content=item["value"],
                 belief=item.get("belief", 50) or 50,
                 probability=item.get("probability", 100) or 100,
                 accuracy=item.get("accuracy", 0) or 0,
             )
-            v = KBValue(content=item["value"], non_factor=nf)
-            solver.wm.set_value(item["ref"], v)
+            for item in items
+        ]
+
+    async def update_solver_wm(
+        self, items: List[WMItemDict], clear_before: bool, auth_token: str = None, removed: List[str] = None
+    ) -> List[str]:
+        auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
+        solver = self.get_solver(auth_token_or_user_id=auth_token_or_user_id)
+        changed = solver.wm.update_values(self.get_wm_updates(items), clear_before=clear_before)
+        if removed:
+            changed += solver.wm.reset_values(removed)
+        return changed
+
+    @staticmethod
+    def is_method_not_found(error: Exception, method: str) -> bool:
+        """Whether the external call failed because the component has no such method, not for a transient reason."""
+        if isinstance(error, (AttributeError, NotImplementedError)):
+            return True
+        message = str(error).lower()
+        return method.lower() in message and any(marker in message for marker in METHOD_NOT_FOUND_MARKERS)
 
+    @authorized_method
+    async def apply_wm_delta(
+        self, items: List[WMItemDict], clear_before: bool = False, auth_token: str = None
+    ) -> List[str]:
+        """Applies only the changed values and returns their references."""
+        return await self.update_solver_wm(items, clear_before=clear_before, auth_token=auth_token)
+
+    @authorized_method
+    async def update_wm(self, items: List[WMItemDict], clear_before: bool = True, auth_token: str = None) -> bool:
+        await self.update_solver_wm(items, clear_before=clear_before, auth_token=auth_token)
         return True
 
     @authorized_method
-    async def update_wm_from_bb(self, clear_before: bool = True, auth_token: str = None) -> bool:
+    async def update_wm_from_bb(
+        self, clear_before: bool = True, incremental: bool = False, auth_token: str = None
+    ) -> bool:
+        """Syncs the working memory with the blackboard.
+
+        With ``incremental`` the solver requests only the items changed since the last synced blackboard revision
+        by ``ATBlackBoard.get_items_since``, items removed since then are reset. The first sync, a sync after the
+        working memory was replaced and a sync with a blackboard that does not have ``get_items_since`` fetch all
+        items instead. Other failures of the incremental request are raised.
+        """
+        solver = None
+        if incremental:
+            auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
+            solver = self.get_solver(auth_token_or_user_id=auth_token_or_user_id)
+        if solver is not None and solver.bb_revisions_supported:
+            try:
+                delta: BBItemsSinceDict = await self.exec_external_method(
+                    "ATBlackBoard", "get_items_since", {"revision": solver.bb_revision}, auth_token=auth_token
+                )
+            except Exception as e:
+                if not self.is_method_not_found(e, "get_items_since"):
+                    raise
+                logger.warning(f"Blackboard does not support incremental sync, falling back to full sync: {e}")
+                solver.bb_revisions_supported = False
+            else:
+                # a full answer is given for the first sync or when the blackboard has no changes log since revision
+                full = solver.bb_revision is None or delta.get("full", False)
+                await self.update_solver_wm(
+                    delta["items"],
+                    clear_before=full and clear_before,
+                    auth_token=auth_token,
+                    removed=None if full else delta.get("removed"),
+                )
+                solver.bb_revision = delta["revision"]
+                return True
+
         items = await self.exec_external_method("ATBlackBoard", "get_all_items", {}, auth_token=auth_token)
         return await self.update_wm(items=items, clear_before=clear_before, auth_token=auth_token)
 
@@ -252,6 +515,18 @@ class ATSolver(ATComponent):
         solver.mode = mode
         return True
 
+    @authorized_method
+    async def set_strategy(
+        self, strategy: str, priorities: Dict[str, Union[int, float]] = None, auth_token: str = None
+    ) -> bool:
+        if strategy not in AGENDA_STRATEGY.all():
+            raise ValueError(f'Invalid agenda strategy "{strategy}"')
+
+        auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
+        solver = self.get_solver(auth_token_or_user_id=auth_token_or_user_id)
+        solver.set_strategy(strategy, priorities=priorities)
+        return True
+
     @authorized_method
     async def get_trace_and_wm(self, auth_token: str) -> RunResultDict:
         auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
@@ -263,12 +538,15 @@ class ATSolver(ATComponent):
         auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
         solver = self.get_solver(auth_token_or_user_id=auth_token_or_user_id)
         solver.wm = WorkingMemory(kb=solver.kb)
-        solver.trace = Trace()
+        solver.trace = Trace(level=solver.trace_level)
         return True
 
     @authorized_method
-    async def run(self, auth_token: str) -> RunResultDict:
+    async def run(self, auth_token: str, trace_level: str = None) -> RunResultDict:
+        if trace_level is not None and trace_level not in TRACE_LEVEL.all():
+            raise ValueError(f'Invalid trace level "{trace_level}"')
+
         auth_token_or_user_id = await self.get_user_id_or_token(auth_token, raize_on_failed=False)
         solver = self.get_solver(auth_token_or_user_id=auth_token_or_user_id)
-        trace = await solver.run()
+        trace = await solver.run(trace_level=trace_level)
         return {"trace": trace.__dict__, "wm": solver.wm.all_values_dict}
@@ -0,0 +1,105 @@
+import heapq
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+
+def strongly_connected_components(graph: Dict[Hashable, Iterable[Hashable]]) -> List[List[Hashable]]:
+    """Strongly connected components of the graph (Tarjan's algorithm without recursion).
+
+    Components are returned in reverse topological order: a component comes before the components that have
+    edges into it. Nodes which are only mentioned as edge targets are also included.
+    """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    counter = 0
+
+    for root in list(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, edges = work[-1]
+            for target in edges:
+                if target not in index:
+                    index[target] = lowlink[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(graph.get(target, ()))))
+                    break
+                elif target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component[::-1])
+    return components
+
+
+def find_cycles(graph: Dict[Hashable, Iterable[Hashable]]) -> List[List[Hashable]]:
+    """Groups of nodes that depend on each other: components with more than one node or with a self loop."""
+    return [
+        component
+        for component in strongly_connected_components(graph)
+        if len(component) > 1 or component[0] in graph.get(component[0], ())
+    ]
+
+
+def ordered_components(
+    graph: Dict[Hashable, Iterable[Hashable]], key: Optional[Callable[[Hashable], Any]] = None
+) -> List[List[Hashable]]:
+    """Strongly connected components of the graph in topological order (Kahn's algorithm over the components).
+
+    A component comes after the components that have edges into it. Of the components that are ready at the same
+    time the one with the least node comes first (nodes are compared by ``key``), so the order of nodes is kept
+    wherever the graph allows it.
+    """
+    key = key or (lambda node: node)
+    components = strongly_connected_components(graph)
+    component_of = {}
+    for number, component in enumerate(components):
+        for node in component:
+            component_of[node] = number
+    successors = [set() for _ in components]
+    indegrees = [0] * len(components)
+    for node, targets in graph.items():
+        source = component_of[node]
+        for target in targets:
+            target = component_of[target]
+            if target != source and target not in successors[source]:
+                successors[source].add(target)
+                indegrees[target] += 1
+    ranks = [min(key(node) for node in component) for component in components]
+    ready = [(ranks[number], number) for number in range(len(components)) if not indegrees[number]]
+    heapq.heapify(ready)
+    result = []
+    while ready:
+        _, number = heapq.heappop(ready)
+        result.append(sorted(components[number], key=key))
+        for target in successors[number]:
+            indegrees[target] -= 1
+            if not indegrees[target]:
+                heapq.heappush(ready, (ranks[target], target))
+    return result
@@ -1,4 +1,8 @@
+from typing import Callable
+from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Set
 from typing import TYPE_CHECKING
 from typing import Union
 
@@ -11,6 +15,10 @@ from at_krl.core.simple.simple_operation import SimpleOperation
 from at_krl.core.simple.simple_reference import SimpleReference
 from at_krl.core.temporal.allen_operation import AllenEvaluatable
 
+from at_solver.core.dependencies import strongly_connected_components
+from at_solver.core.references import get_reference_keys
+from at_solver.core.references import reference_key
+
 if TYPE_CHECKING:
     from at_solver.core.solver import Solver
 
@@ -25,7 +33,7 @@ class Goal:
         self.ref = ref
         self._goal_tree_map = goal_tree_map
         if self.goal_tree_map is not None:
-            self.goal_tree_map.all_goals.append(self)
+            self.goal_tree_map.register_goal(self)
 
     @property
     def goal_tree_map(self):
@@ -36,12 +44,11 @@ class Goal:
         if self._subgoals is None:
             self._subgoals = []
             if self.goal_tree_map is not None:
-                for rule in self.goal_tree_map.kb.world.rules:
-                    if self.goal_tree_map.rule_has_ref_in_instructions(rule, self.ref):
-                        self._subgoals += [
-                            self.goal_tree_map.get_or_create_goal_by_ref(ref)
-                            for ref in self.goal_tree_map.get_rule_condition_references(rule)
-                        ]
+                for rule in self.goal_tree_map.get_rules_assigning_ref(self.ref, include_else=True):
+                    self._subgoals += [
+                        self.goal_tree_map.get_or_create_goal_by_ref(ref)
+                        for ref in self.goal_tree_map.get_rule_condition_references(rule)
+                    ]
         return self._subgoals
 
     @property
@@ -49,29 +56,22 @@ class Goal:
         if self._pregoals is None:
             self._pregoals = []
             if self.goal_tree_map is not None:
-                for rule in self.goal_tree_map.kb.world.rules:
-                    if self.goal_tree_map.rule_has_ref_in_condition(rule, self.ref):
-                        self._pregoals += [
-                            self.goal_tree_map.get_or_create_goal_by_ref(ref)
-                            for ref in self.goal_tree_map.get_rule_instructions_references(rule)
-                        ]
+                for rule in self.goal_tree_map.get_rules_reading_ref(self.ref):
+                    self._pregoals += [
+                        self.goal_tree_map.get_or_create_goal_by_ref(ref)
+                        for ref in self.goal_tree_map.get_rule_instructions_references(rule)
+                    ]
         return self._pregoals
 
-    def get_best_subgoal(self, solver: "Solver", current_best: "Goal" = None, watched_subgoals: List["Goal"] = None):
-        watched_subgoals = watched_subgoals or []
-        watched_subgoals.append(self)
-        if solver.goal_is_reached(self):
-            return current_best
+    def get_best_subgoal(self, solver: "Solver") -> Union["Goal", None]:
+        """Unreached leaf subgoal with the most pregoals, found by depth-first search in subgoals order.
 
-        current_best = current_best or self
-        if len(self.subgoals):
-            for sg in self.subgoals:
-                if sg not in watched_subgoals:
-                    current_best = sg.get_best_subgoal(solver, current_best, watched_subgoals=watched_subgoals)
-        else:
-            if len(current_best.pregoals) < len(self.pregoals):
-                return self
-        return current_best
+        The goal itself is the best subgoal when it has no unreached leaf subgoal with more pregoals,
+        and None is returned when the goal is already reached.
+        """
+        if self.goal_tree_map is None:
+            return None if solver.goal_is_reached(self) else self
+        return self.goal_tree_map.get_best_subgoal(self, solver.goal_is_reached)
 
 
 class GoalTreeMap:
@@ -79,16 +79,73 @@ class GoalTreeMap:
     _final_goals: List[Goal] = None
     _kb: KnowledgeBase
     all_goals: List[Goal] = None
+    _goals_by_key: Dict[str, Goal] = None
+    rules: List[KBRule] = None
+    _rule_ordinals: Dict[int, int] = None
+    condition_index: Dict[str, List[int]] = None
+    instructions_index: Dict[str, List[int]] = None
+    else_instructions_index: Dict[str, List[int]] = None
+    _node_index: Dict[str, int] = None
+    _node_goals: List[Goal] = None
+    _subgoal_edges: List[List[int]] = None
+    _pregoal_counts: List[int] = None
+    _reachable_rules: List[int] = None
 
     def __init__(self, kb) -> None:
         self._kb = kb
         self.all_goals = []
+        self._goals_by_key = {}
+        self.build_index()
         self.build()
 
+    def build_index(self) -> None:
+        """Indexes rules by canonical keys of the references they read in condition or assign in instructions.
+
+        Each index maps a reference key to the ordinals of the rules in ``self.rules`` (in rule order).
+        """
+        self.rules = list(self.kb.world.rules)
+        self._rule_ordinals = {id(rule): ordinal for ordinal, rule in enumerate(self.rules)}
+        self.condition_index = {}
+        self.instructions_index = {}
+        self.else_instructions_index = {}
+        for ordinal, rule in enumerate(self.rules):
+            for ref in self.get_rule_condition_references(rule):
+                self._add_to_index(self.condition_index, ref, ordinal)
+            for ref in self.get_rule_instructions_references(rule):
+                self._add_to_index(self.instructions_index, ref, ordinal)
+            for ref in self.get_rule_else_instrctions_references(rule):
+                self._add_to_index(self.else_instructions_index, ref, ordinal)
+
+    def get_rule_ordinal(self, rule: KBRule) -> int:
+        return self._rule_ordinals[id(rule)]
+
+    @staticmethod
+    def _add_to_index(index: Dict[str, List[int]], ref: KBReference, ordinal: int) -> None:
+        ordinals = index.setdefault(reference_key(ref), [])
+        if not ordinals or ordinals[-1] != ordinal:
+            ordinals.append(ordinal)
+
+    def get_rules_reading_ref(self, ref: KBReference) -> List[KBRule]:
+        return [self.rules[ordinal] for ordinal in self.condition_index.get(reference_key(ref), ())]
+
+    def get_rules_assigning_ref(self, ref: KBReference, include_else: bool = False) -> List[KBRule]:
+        key = reference_key(ref)
+        ordinals = self.instructions_index.get(key, [])
+        if include_else and key in self.else_instructions_index:
+            ordinals = sorted(set(ordinals).union(self.else_instructions_index[key]))
+        return [self.rules[ordinal] for ordinal in ordinals]
+
+    def get_rules_else_assigning_ref(self, ref: KBReference) -> List[KBRule]:
+        return [self.rules[ordinal] for ordinal in self.else_instructions_index.get(reference_key(ref), ())]
+
+    def register_goal(self, goal: Goal) -> None:
+        self.all_goals.append(goal)
+        self._goals_by_key.setdefault(reference_key(goal.ref), goal)
+        # the closure is rebuilt with the new goal when it is requested
+        self._node_index = None
+
     def get_goal_by_ref(self, ref: KBReference) -> Union[Goal, None]:
-        for g in self.all_goals:
-            if self.check_references_equal(g.ref, ref):
-                return g
+        return self._goals_by_key.get(reference_key(ref))
 
     def get_or_create_goal_by_ref(self, ref: KBReference) -> Goal:
         goal = self.get_goal_by_ref(ref)
@@ -103,7 +160,7 @@ class GoalTreeMap:
     def build(self) -> None:
         self.root_goals
         self.final_goals
-        for rule in self.kb.world.rules:
+        for rule in self.rules:
             for ref in self.get_rule_condition_references(rule):
                 self.get_or_create_goal_by_ref(ref)
             for ref in self.get_rule_instructions_references(rule):
@@ -112,14 +169,151 @@ class GoalTreeMap:
             goal.subgoals
             goal.pregoals
 
+    def build_closure(self) -> None:
+        """Builds the goal graph with integer nodes and the rules reachable from every goal.
+
+        Edges go from a goal to its subgoals. ``_reachable_rules`` is a bitset of ordinals of the rules which assign
+        (in instructions) the goal or any goal reachable from it by subgoals. It is computed once over strongly
+        connected components of the graph, so cyclic goal dependencies share one bitset. Registering a goal
+        invalidates the closure, and it is built again when a goal node is requested.
+        """
+        # subgoals can create goals, which are registered before the nodes are added
+        index = 0
+        while index < len(self.all_goals):
+            self.all_goals[index].subgoals
+            self.all_goals[index].pregoals
+            index += 1
+        self._node_index = {}
+        self._node_goals = []
+        self._subgoal_edges = []
+        self._pregoal_counts = []
+        self._reachable_rules = []
+        for goal in self.all_goals:
+            self._add_node(goal)
+        for node, goal in enumerate(self._node_goals):
+            self._subgoal_edges[node] = [self._add_node(subgoal) for subgoal in goal.subgoals]
+
+        graph = {node: edges for node, edges in enumerate(self._subgoal_edges)}
+        for component in strongly_connected_components(graph):
+            members = set(component)
+            reachable = 0
+            for node in component:
+                reachable |= self._get_assigning_rules_bits(node)
+                for target in self._subgoal_edges[node]:
+                    if target not in members:
+                        reachable |= self._reachable_rules[target]
+            for node in component:
+                self._reachable_rules[node] = reachable
+
+    def _add_node(self, goal: Goal) -> int:
+        key = reference_key(goal.ref)
+        node = self._node_index.get(key)
+        if node is None:
+            node = len(self._node_goals)
+            self._node_index[key] = node
+            self._node_goals.append(goal)
+            self._subgoal_edges.append([])
+            self._pregoal_counts.append(len(goal.pregoals))
+            self._reachable_rules.append(0)
+        return node
+
+    def _get_assigning_rules_bits(self, node: int) -> int:
+        bits = 0
+        for ordinal in self.instructions_index.get(reference_key(self._node_goals[node].ref), ()):
+            bits |= 1 << ordinal
+        return bits
+
+    def get_goal_node(self, goal: Goal) -> int:
+        key = reference_key(goal.ref)
+        if self._node_index is None or key not in self._node_index:
+            self.get_or_create_goal_by_ref(goal.ref)
+            self.build_closure()
+        return self._node_index[key]
+
+    def get_reachable_rules_bits(self, goal: Goal) -> int:
+        return self._reachable_rules[self.get_goal_node(goal)]
+
+    def can_reach_goal_by_rules(self, goal: Goal, rules: Iterable[KBRule]) -> bool:
+        """Whether any of the rules assigns the goal or a goal it depends on through subgoals."""
+        reachable = self.get_reachable_rules_bits(goal)
+        return any(reachable >> self.get_rule_ordinal(rule) & 1 for rule in rules)
+
+    def get_relevant_rules(self, goals: List[Goal]) -> Set[int]:
+        """Ordinals of the rules which can contribute to the goals (backward slice of the knowledge base).
+
+        These are the rules assigning (in instructions or in else instructions) the goals or any property read by
+        the rules of the slice, in conditions or in assigned values. Other rules can not change what the goals
+        depend on. Default values are evaluated once when the knowledge base is loaded, so they add no dependencies.
+        """
+        keys = [reference_key(goal.ref) for goal in goals]
+        visited = set(keys)
+        ordinals = set()
+        while keys:
+            key = keys.pop()
+            for ordinal in self.instructions_index.get(key, []) + self.else_instructions_index.get(key, []):
+                if ordinal in ordinals:
+                    continue
+                ordinals.add(ordinal)
+                for read in self.get_rule_read_keys(self.rules[ordinal]):
+                    if read not in visited:
+                        visited.add(read)
+                        keys.append(read)
+        return ordinals
+
+    def get_best_subgoal(self, goal: Goal, is_reached: Callable[[Goal], bool]) -> Union[Goal, None]:
+        start = self.get_goal_node(goal)
+        if is_reached(goal):
+            return None
+        best = start
+        visited = {start}
+        stack = [iter(self._subgoal_edges[start])]
+        while stack:
+            for node in stack[-1]:
+                if node in visited:
+                    continue
+                visited.add(node)
+                if is_reached(self._node_goals[node]):
+                    continue
+                if self._subgoal_edges[node]:
+                    stack.append(iter(self._subgoal_edges[node]))
+                    break
+                if self._pregoal_counts[best] < self._pregoal_counts[node]:
+                    best = node
+            else:
+                stack.pop()
+        return self._node_goals[best]
+
+    def get_required_leaf_subgoals(self, goal: Goal, leaf: Goal, is_reached: Callable[[Goal], bool]) -> List[Goal]:
+        """The leaf with the unreached leaf subgoals read together with it by the rules leading to the goal.
+
+        Leaves are subgoals which have no subgoals and are not assigned by rules, so they can only be requested.
+        Only the rules which read the leaf in condition and assign the goal or one of its subgoals are followed,
+        so leaves needed only by alternative rules are not included.
+        """
+        reachable = self.get_reachable_rules_bits(goal)
+        result = [leaf]
+        seen = {reference_key(leaf.ref)}
+        for ordinal in self.condition_index.get(reference_key(leaf.ref), ()):
+            if not reachable >> ordinal & 1:
+                continue
+            for ref in self.get_rule_condition_references(self.rules[ordinal]):
+                key = reference_key(ref)
+                if key in seen:
+                    continue
+                seen.add(key)
+                subgoal = self.get_or_create_goal_by_ref(ref)
+                if not is_reached(subgoal) and not self.get_rules_assigning_ref(ref, include_else=True):
+                    result.append(subgoal)
+        return result
+
     @property
     def final_goals(self) -> List[Goal]:
         if self._final_goals is None:
             self._final_goals = []
-            for rule in self.kb.world.rules:
+            for rule in self.rules:
                 instr_references = self.get_rule_instructions_references(rule)
                 for ref in instr_references:
-                    if not len([r for r in self.kb.world.rules if not self.rule_has_ref_in_condition(r, ref)]):
+                    if len(self.get_rules_reading_ref(ref)) == len(self.rules):
                         self._final_goals.append(self.get_or_create_goal_by_ref(ref))
         return self._final_goals
 
@@ -127,10 +321,10 @@ class GoalTreeMap:
     def root_goals(self) -> List[Goal]:
         if self._root_goals is None:
             self._root_goals = []
-            for rule in self.kb.world.rules:
+            for rule in self.rules:
                 condition_references = self.get_rule_condition_references(rule)
                 for ref in condition_references:
-                    if not len([r for r in self.kb.world.rules if not self.rule_has_ref_in_instructions(r, ref)]):
+                    if len(self.get_rules_assigning_ref(ref, include_else=True)) == len(self.rules):
                         self._root_goals.append(self.get_or_create_goal_by_ref(ref))
         return self._root_goals
 
@@ -148,6 +342,15 @@ class GoalTreeMap:
             return []
         return [instr.ref for instr in rule.else_instructions if isinstance(instr, AssignInstruction)]
 
+    @staticmethod
+    def get_rule_read_keys(rule: KBRule) -> Set[str]:
+        """Keys of the properties the rule reads in condition and in assigned values."""
+        keys = [reference_key(ref) for ref in GoalTreeMap.get_rule_condition_references(rule)]
+        for instruction in rule.instructions + (rule.else_instructions or []):
+            if isinstance(instruction, AssignInstruction):
+                keys += get_reference_keys(instruction.value)
+        return set(keys)
+
     @staticmethod
     def get_evaluatable_references(e: Evaluatable) -> List[KBReference]:
         if e is None:
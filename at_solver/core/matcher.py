@@ -0,0 +1,166 @@
+from typing import Container
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+
+from at_krl.core.kb_rule import KBRule
+from at_krl.core.kb_value import Evaluatable
+from at_krl.core.kb_value import KBValue
+from at_krl.core.simple.simple_operation import SimpleOperation
+from at_krl.core.temporal.allen_operation import AllenEvaluatable
+
+from at_solver.core.agenda import Agenda
+from at_solver.core.goals import GoalTreeMap
+from at_solver.core.references import get_reference_keys
+from at_solver.core.references import reference_key
+from at_solver.core.wm import WMChange
+from at_solver.core.wm import WorkingMemory
+from at_solver.evaluations.compiled import ExpressionCompiler
+
+
+class RuleMatcher:
+    """Dependency-driven forward matcher.
+
+    Uses the condition index of the goal tree map, which is built once per knowledge base. Evaluated conditions
+    are kept between steps and only the rules whose condition references were changed in the bound working memory
+    are evaluated again. Rules with temporal (Allen) conditions read values computed by the temporal solver and
+    are evaluated on every match. Matching can be restricted to a slice of rules by ``restrict``.
+
+    A change also makes dirty the rules reading properties whose values are expressions reading the changed one.
+    These are expressions assigned to the bound working memory; default values are evaluated once when the
+    knowledge base is loaded, so they do not link properties.
+    """
+
+    goal_tree: GoalTreeMap
+    expressions: ExpressionCompiler
+    agenda: Agenda
+    _volatile: Set[int]
+    _dirty: Set[int]
+    _applicable: Dict[int, KBValue]
+    # keys of the properties whose value expressions in the bound working memory read the key
+    _linked_readers: Dict[str, Set[str]]
+    # ordinals of the rules considered by matching, None for all rules
+    _slice: Optional[Set[int]] = None
+    _wm: WorkingMemory = None
+
+    def __init__(self, goal_tree: GoalTreeMap, expressions: ExpressionCompiler, agenda: Agenda) -> None:
+        self.goal_tree = goal_tree
+        self.expressions = expressions
+        self.agenda = agenda
+        self._volatile = set()
+        for ordinal, rule in enumerate(self.rules):
+            if self.is_volatile(rule.condition):
+                self._volatile.add(ordinal)
+        self._applicable = {}
+        self._linked_readers = {}
+        self.invalidate()
+
+    @property
+    def rules(self) -> List[KBRule]:
+        return self.goal_tree.rules
+
+    @staticmethod
+    def is_volatile(e: Evaluatable) -> bool:
+        if isinstance(e, AllenEvaluatable):
+            return True
+        if isinstance(e, SimpleOperation):
+            return RuleMatcher.is_volatile(e.left) or RuleMatcher.is_volatile(e.right)
+        return False
+
+    @staticmethod
+    def rule_is_applicable(rule: KBRule, evaluated_condition: KBValue) -> bool:
+        if evaluated_condition is None or evaluated_condition.content is None:
+            return False
+        if evaluated_condition.content:
+            return bool(rule.instructions)
+        return bool(rule.else_instructions)
+
+    def set_agenda(self, agenda: Agenda):
+        agenda.copy_recency(self.agenda)
+        self.agenda = agenda
+        for ordinal in self._applicable:
+            agenda.activate(ordinal)
+
+    def restrict(self, ordinals: Optional[Set[int]]):
+        """Matches only the rules with the ordinals, or all rules when ``ordinals`` is None."""
+        self._slice = ordinals
+        if ordinals is not None:
+            for ordinal in list(self._applicable):
+                if ordinal not in ordinals:
+                    del self._applicable[ordinal]
+                    self.agenda.deactivate(ordinal)
+        self.invalidate()
+
+    def invalidate(self):
+        self._dirty = set(range(len(self.rules)))
+
+    def bind(self, wm: WorkingMemory):
+        if self._wm is wm:
+            return
+        if self._wm is not None:
+            self._wm.unsubscribe(self.on_change)
+        self._wm = wm
+        wm.subscribe(self.on_change)
+        self._linked_readers = {}
+        self._applicable = {}
+        self.agenda.clear()
+        self.invalidate()
+
+    def on_change(self, change: WMChange):
+        key = reference_key(change.ref)
+        if WorkingMemory.is_expression(change.old):
+            for dependency in get_reference_keys(change.old):
+                self._linked_readers.get(dependency, set()).discard(key)
+        if WorkingMemory.is_expression(change.new):
+            for dependency in get_reference_keys(change.new):
+                self._linked_readers.setdefault(dependency, set()).add(key)
+        affected = self.get_affected_keys(key)
+        affected.discard(key)
+        for affected_key in sorted(affected) + [key]:
+            self.agenda.touch(affected_key)
+            self._dirty.update(self.goal_tree.condition_index.get(affected_key, ()))
+
+    def get_affected_keys(self, key: str) -> Set[str]:
+        """The key and the keys of the properties whose value expressions read it, directly or through others."""
+        affected = {key}
+        stack = [key]
+        while stack:
+            current = stack.pop()
+            for reader in self._linked_readers.get(current, ()):
+                if reader not in affected:
+                    affected.add(reader)
+                    stack.append(reader)
+        return affected
+
+    def match(self, wm: WorkingMemory, fired_rules: Container[KBRule]) -> List[KBRule]:
+        return list(self.iter_matches(wm, fired_rules))
+
+    def iter_matches(self, wm: WorkingMemory, fired_rules: Container[KBRule]) -> Iterator[KBRule]:
+        """Applicable rules in the agenda order. Conditions are evaluated at once, the agenda is walked lazily."""
+        self.bind(wm)
+        candidates = self._dirty | self._volatile
+        if self._slice is not None:
+            candidates &= self._slice
+        for ordinal in candidates:
+            rule = self.rules[ordinal]
+            if rule in fired_rules:
+                continue
+            self._dirty.discard(ordinal)
+            evaluated_condition = self.expressions.eval(rule.condition, wm)
+            if self.rule_is_applicable(rule, evaluated_condition):
+                self._applicable[ordinal] = evaluated_condition
+                self.agenda.activate(ordinal)
+            else:
+                self._applicable.pop(ordinal, None)
+                self.agenda.deactivate(ordinal)
+
+        return self._iter_applicable(fired_rules)
+
+    def _iter_applicable(self, fired_rules: Container[KBRule]) -> Iterator[KBRule]:
+        for ordinal in self.agenda.ordered():
+            rule = self.rules[ordinal]
+            if rule not in fired_rules:
+                rule.evaluated_condition = self._applicable[ordinal]
+                yield rule
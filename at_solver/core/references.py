@@ -0,0 +1,77 @@
+import sys
+from collections import OrderedDict
+from typing import List
+from typing import Tuple
+
+from at_krl.core.kb_reference import KBReference
+from at_krl.core.kb_value import Evaluatable
+from at_krl.core.simple.simple_operation import SimpleOperation
+from at_krl.core.simple.simple_reference import SimpleReference
+
+
+def reference_key(ref: SimpleReference) -> str:
+    """Canonical dotted path of the reference (for example ``object1.attr1``).
+
+    Two references have the same key exactly when ``GoalTreeMap.check_references_equal`` considers them equal,
+    so the key can be used for hashing references in dicts and sets.
+    """
+    ids = []
+    while ref is not None:
+        ids.append(ref.id)
+        ref = ref.ref
+    return sys.intern(".".join(ids))
+
+
+def get_reference_keys(v: Evaluatable) -> List[str]:
+    """Keys of the references read by the expression, without duplicates."""
+    if isinstance(v, SimpleReference):
+        return [reference_key(v)]
+    elif isinstance(v, SimpleOperation):
+        keys = get_reference_keys(v.left)
+        if v.is_binary:
+            keys += [key for key in get_reference_keys(v.right) if key not in keys]
+        return keys
+    return []
+
+
+class ReferenceCache:
+    """Bounded LRU cache of parsed reference paths and of krl strings of references.
+
+    Parsed references are shared between callers, so they must not be modified.
+    """
+
+    maxsize: int
+    _paths: "OrderedDict[str, Tuple[KBReference, str]]"
+    _krls: "OrderedDict[int, Tuple[SimpleReference, str]]"
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self._paths = OrderedDict()
+        self._krls = OrderedDict()
+
+    def resolve(self, path: str) -> Tuple[KBReference, str]:
+        """Parsed reference for the path and its canonical key."""
+        resolved = self._paths.get(path)
+        if resolved is None:
+            ref = KBReference.from_simple(KBReference.parse(path))
+            resolved = (ref, reference_key(ref))
+            self._paths[path] = resolved
+            if len(self._paths) > self.maxsize:
+                self._paths.popitem(last=False)
+        else:
+            self._paths.move_to_end(path)
+        return resolved
+
+    def parse(self, path: str) -> KBReference:
+        return self.resolve(path)[0]
+
+    def krl(self, ref: SimpleReference) -> str:
+        cached = self._krls.get(id(ref))
+        if cached is None or cached[0] is not ref:
+            cached = (ref, ref.to_simple().krl)
+            self._krls[id(ref)] = cached
+            if len(self._krls) > self.maxsize:
+                self._krls.popitem(last=False)
+        else:
+            self._krls.move_to_end(id(ref))
+        return cached[1]
@@ -2,24 +2,44 @@ import asyncio
 import inspect
 from typing import Awaitable
 from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Set
 from typing import Union
 
 from at_krl.core.kb_instruction import AssignInstruction
 from at_krl.core.kb_instruction import KBInstruction
 from at_krl.core.kb_rule import KBRule
+from at_krl.core.kb_value import KBValue
 from at_krl.core.knowledge_base import KnowledgeBase
+from at_krl.core.non_factor import NonFactor
 from at_krl.models.kb_value import KBValueModel
 from at_krl.utils.context import Context
 
+from at_solver.core.agenda import Agenda
 from at_solver.core.goals import Goal
 from at_solver.core.goals import GoalTreeMap
+from at_solver.core.matcher import RuleMatcher
+from at_solver.core.references import reference_key
+from at_solver.core.strata import RuleStrata
+from at_solver.core.trace import FiredRules
 from at_solver.core.trace import ForwardStep
 from at_solver.core.trace import ReachGoalStep
 from at_solver.core.trace import SelectGoalStep
 from at_solver.core.trace import Trace
+from at_solver.core.trace import TRACE_LEVEL
+from at_solver.core.wm import WMChange
 from at_solver.core.wm import WorkingMemory
-from at_solver.evaluations.basic import BasicEvaluator
+from at_solver.evaluations.basic import materialize
+from at_solver.evaluations.compiled import ExpressionCompiler
+from at_solver.evaluations.fuzzy import FuzzyEvaluator
+from at_solver.evaluations.fuzzy import FuzzyExpressions
+from at_solver.evaluations.fuzzy import FuzzyModel
+from at_solver.evaluations.non_factor import get_non_factor
+from at_solver.evaluations.non_factor import NonFactorCalculus
 
 
 class SOLVER_MODE:
@@ -28,9 +48,35 @@ class SOLVER_MODE:
     mixed = "mixed"
 
 
+class SOLVER_EVALUATOR:
+    basic = "basic"
+    fuzzy = "fuzzy"
+
+    @classmethod
+    def all(cls) -> List[str]:
+        return [cls.basic, cls.fuzzy]
+
+
 class Solver:
-    wm: WorkingMemory = None
+    _wm: WorkingMemory = None
     trace: Trace = None
+    trace_level: str = None
+    matcher: RuleMatcher = None
+    agenda: Agenda = None
+    expressions: Union[ExpressionCompiler, FuzzyExpressions] = None
+    non_factors: NonFactorCalculus = None
+    evaluator: str = None
+    # number of values requested concurrently in async backward and mixed runs, 0 requests one value per step;
+    # the values are the leaves read together by the rules leading to the current goal
+    prefetch_concurrency: int = 0
+    # restricts matching to the rules which can contribute to the goals, when goals are set
+    goal_slicing: bool = True
+    # ordinals of the rules matched when goal slicing is applied, None for all rules
+    relevant_rules: Optional[Set[int]] = None
+    # evaluates forward runs in one pass over the rule strata, see run_stratified
+    stratified: bool = False
+    _strata: RuleStrata = None
+    fuzzy_conclusions: Dict[str, Dict[str, float]] = None
 
     mode: str = None
     goal_tree: GoalTreeMap = None
@@ -38,71 +84,190 @@ class Solver:
     goal_stack: List[Goal] = None
     _watched_goals: List[Goal] = None
     on_request_value: Union[Callable, Awaitable] = None
-
-    def __init__(self, kb: KnowledgeBase, mode: str, goals: List[Goal]) -> None:
+    # revision of the blackboard the working memory was synced with, None when it is not synced
+    bb_revision: Union[int, str, None] = None
+    # False when the blackboard of the solver turned out to have no revisions log (``get_items_since``)
+    bb_revisions_supported: bool = True
+
+    def __init__(
+        self,
+        kb: KnowledgeBase,
+        mode: str,
+        goals: List[Goal],
+        strategy: str = None,
+        priorities: Dict[str, Union[int, float]] = None,
+        trace_level: str = None,
+        non_factors: NonFactorCalculus = None,
+        evaluator: str = None,
+        prefetch_concurrency: int = 0,
+        goal_slicing: bool = True,
+        stratified: bool = False,
+    ) -> None:
+        evaluator = evaluator or SOLVER_EVALUATOR.basic
+        if evaluator not in SOLVER_EVALUATOR.all():
+            raise ValueError(f'Invalid evaluator "{evaluator}"')
+        if evaluator == SOLVER_EVALUATOR.fuzzy and non_factors is not None:
+            raise ValueError("Non-factor propagation is not supported by the fuzzy evaluator")
+        self.goal_tree = GoalTreeMap(kb)
+        self.non_factors = non_factors
+        self.evaluator = evaluator
+        self.prefetch_concurrency = prefetch_concurrency or 0
+        self.fuzzy_conclusions = {}
+        if evaluator == SOLVER_EVALUATOR.fuzzy:
+            self.expressions = FuzzyExpressions(FuzzyModel.from_templates(WorkingMemory(kb=kb).get_templates()))
+        else:
+            self.expressions = ExpressionCompiler(non_factors=non_factors)
+        self.expressions.compile_rules(self.goal_tree.rules)
+        self.agenda = Agenda(self.goal_tree, strategy=strategy, priorities=priorities)
+        self.matcher = RuleMatcher(self.goal_tree, self.expressions, self.agenda)
         self.wm = WorkingMemory(kb=kb)
         self.mode = mode
-        self.goal_tree = GoalTreeMap(kb)
-        self.goals = [self.goal_tree.get_or_create_goal_by_ref(goal.ref) for goal in goals]
-        self.trace = Trace()
+        self.goal_slicing = goal_slicing
+        self.stratified = stratified
+        self.set_goals(goals)
+        self.trace_level = trace_level or TRACE_LEVEL.full
+        self.trace = Trace(level=self.trace_level)
         self.goal_stack = []
         self._watched_goals = []
 
+    @property
+    def wm(self) -> WorkingMemory:
+        return self._wm
+
+    @wm.setter
+    def wm(self, wm: WorkingMemory):
+        if self._wm is not None:
+            self._wm.unsubscribe(self._record_change)
+        self._wm = wm
+        self.bb_revision = None
+        self.expressions.clear_cache()
+        wm.subscribe(self._record_change)
+        self.matcher.bind(wm)
+
+    def _record_change(self, change: WMChange):
+        if self.trace is not None:
+            self.trace.record(change)
+
     @property
     def kb(self) -> KnowledgeBase:
         return self.wm.kb
 
     def set_goals(self, goals: List[Goal]):
         self.goals = [self.goal_tree.get_or_create_goal_by_ref(goal.ref) for goal in goals]
+        self.update_slice()
+
+    def set_goal_slicing(self, goal_slicing: bool):
+        self.goal_slicing = goal_slicing
+        self.update_slice()
+
+    def update_slice(self):
+        self.relevant_rules = None
+        if self.goal_slicing and self.goals:
+            self.relevant_rules = self.goal_tree.get_relevant_rules(self.goals)
+        self.matcher.restrict(self.relevant_rules)
+
+    @property
+    def strata(self) -> RuleStrata:
+        if self._strata is None:
+            self._strata = RuleStrata(self.goal_tree)
+        return self._strata
 
     def reset_wm(self):
         self.wm = WorkingMemory(kb=self.wm.kb)
 
     @property
-    def fired_rules(self) -> List[KBRule]:
-        relevant_steps = [step for step in self.trace.steps if hasattr(step, "fired_rules")]
-        if relevant_steps:
-            return relevant_steps[-1].fired_rules
-        return []
+    def fired_rules(self) -> FiredRules:
+        return self.trace.fired_rules
+
+    def set_strategy(self, strategy: str, priorities: Dict[str, Union[int, float]] = None):
+        self.agenda = Agenda(self.goal_tree, strategy=strategy, priorities=priorities)
+        self.matcher.set_agenda(self.agenda)
 
     def match_forward(self) -> List[KBRule]:
-        result = []
-        evaluator = BasicEvaluator(self.wm)
-        for rule in self.wm.env.type.target.rules:
-            if rule not in self.fired_rules:
-                evaluated_condition = evaluator.eval(rule.condition)
-                if evaluated_condition is not None and evaluated_condition.content is not None:
-                    if (
-                        evaluated_condition.content
-                        and rule.instructions
-                        or not evaluated_condition.content
-                        and rule.else_instructions
-                    ):
-                        rule.evaluated_condition = evaluated_condition
-                        result.append(rule)
-        return result  # тут нужна сортировка
+        return self.matcher.match(self.wm, self.fired_rules)
+
+    def iter_forward_matches(self) -> Iterator[KBRule]:
+        """Applicable rules in the agenda order, taken lazily. The iterator must be consumed before rules fire."""
+        return self.matcher.iter_matches(self.wm, self.fired_rules)
+
+    def has_forward_match(self) -> bool:
+        return next(self.iter_forward_matches(), None) is not None
 
     def make_step_forward(self) -> ForwardStep:
-        step = ForwardStep(self.wm)
-        step.conflict_rules = self.match_forward()
+        return self.make_forward_step(self.match_forward())
+
+    def make_forward_step(self, conflict_rules: List[KBRule]) -> ForwardStep:
+        step = ForwardStep(self.trace, self.wm)
+        step.conflict_rules = conflict_rules
         if step.conflict_rules:
             step.selected_rule = step.conflict_rules[0]
             step.rule_condition_value = KBValueModel(
                 **step.selected_rule.evaluated_condition.to_representation()
             ).to_internal(Context(name="trace"))
             self.fire_rule(step.selected_rule)
-            step.fired_rules = self.fired_rules + [step.selected_rule]
+            step.fired_rules = self.trace.fire(step.selected_rule)
             step.final_wm_state = self.wm
         return step
 
-    def run_forward(self) -> Trace:
-        self.trace.steps = []
+    def start(self, trace_level: str = None):
+        self.trace.reset(self.wm, level=trace_level or self.trace_level)
+        self.fuzzy_conclusions = {}
+
+    def finish(self):
+        """Stops journaling working memory changes, so updates between runs are not kept in the trace."""
+        self.trace.finish()
+
+    def run_forward(self, trace_level: str = None) -> Trace:
+        if self.stratified:
+            return self.run_stratified(trace_level=trace_level)
+        self.start(trace_level)
+        try:
+            while True:
+                step = self.make_step_forward()
+                if not step.conflict_rules:
+                    break
+                self.trace.add_step(step)
+        finally:
+            self.finish()
+        return self.trace
 
-        while True:
-            step = self.make_step_forward()
-            if not step.conflict_rules:
-                break
-            self.trace.steps.append(step)
+    def run_stratified(self, trace_level: str = None) -> Trace:
+        """Forward run in one pass over the rule strata.
+
+        Rules of acyclic strata are evaluated once in topological order, rules of cyclic strata are matched
+        iteratively as in ``run_forward``. When the rules are already ordered so that no rule reads what a later
+        rule assigns, rules are fired in the same order with the same results as by ``run_forward`` with the
+        ``first`` strategy. Conflict rules of a step are only the applicable rules of its stratum.
+
+        Dependencies are found statically, expression values assigned to properties at runtime are not followed.
+        """
+        self.start(trace_level)
+        try:
+            for number, component in enumerate(self.strata.components):
+                if self.relevant_rules is not None:
+                    component = [ordinal for ordinal in component if ordinal in self.relevant_rules]
+                    if not component:
+                        continue
+                if self.strata.is_cyclic(number):
+                    self.matcher.restrict(set(component))
+                    try:
+                        while True:
+                            step = self.make_step_forward()
+                            if not step.conflict_rules:
+                                break
+                            self.trace.add_step(step)
+                    finally:
+                        self.matcher.restrict(self.relevant_rules)
+                    continue
+                rule = self.goal_tree.rules[component[0]]
+                if rule in self.fired_rules:
+                    continue
+                evaluated_condition = self.expressions.eval(rule.condition, self.wm)
+                if RuleMatcher.rule_is_applicable(rule, evaluated_condition):
+                    rule.evaluated_condition = evaluated_condition
+                    self.trace.add_step(self.make_forward_step([rule]))
+        finally:
+            self.finish()
         return self.trace
 
     def goal_is_reached(self, goal: Goal):
@@ -110,23 +275,16 @@ class Solver:
         return (v is not None) and (v.content is not None)
 
     def get_rules_goal_depends_on(self, goal) -> List[KBRule]:
-        rules = []
-        for rule in self.wm.env.type.target.rules:
-            rule_refs = self.goal_tree.get_rule_instructions_references(rule)
-            for ref in rule_refs:
-                if self.goal_tree.check_references_equal(ref, goal.ref):
-                    rules.append(rule)
-        return rules
+        return self.goal_tree.get_rules_assigning_ref(goal.ref)
 
     def get_rules_deducting_goal(self, goal: Goal) -> List[KBRule]:
-        evaluator = BasicEvaluator(self.wm)
         rules = []
-        for rule in self.wm.env.type.target.rules:
+        for rule in self.goal_tree.get_rules_assigning_ref(goal.ref, include_else=True):
             rule_refs = self.goal_tree.get_rule_instructions_references(rule)
             rule_else_refs = self.goal_tree.get_rule_else_instrctions_references(rule)
             for ref in rule_refs + rule_else_refs:
                 if self.goal_tree.check_references_equal(ref, goal.ref):
-                    rule_condition_value = evaluator.eval(rule.condition)
+                    rule_condition_value = self.expressions.eval(rule.condition, self.wm)
                     if (rule_condition_value is not None) and rule_condition_value.content is not None:
                         can_add_by_true = rule_condition_value.content and (ref.id in [r.id for r in rule_refs])
                         can_add_by_false = (not rule_condition_value.content) and (
@@ -154,22 +312,10 @@ class Solver:
         return False
 
     def match_backward(self, rules: List[KBRule]) -> List[KBRule]:
-        return rules  # тут нужна сортировка
-
-    def can_reach_goal_by_rules(self, goal: Goal, rules: List[KBRule], watched_subgoals: List[Goal] = None) -> bool:
-        watched_subgoals = watched_subgoals or []
-        watched_subgoals.append(goal)
-        all_goal_rules = self.get_rules_goal_depends_on(goal)
-        for rule in rules:
-            if rule.id in [r.id for r in all_goal_rules]:
-                return True
-        if len(goal.subgoals):
-            for sg in goal.subgoals:
-                if sg not in watched_subgoals and self.can_reach_goal_by_rules(
-                    sg, rules, watched_subgoals=watched_subgoals
-                ):
-                    return True
-        return False
+        return self.agenda.sort(rules)
+
+    def can_reach_goal_by_rules(self, goal: Goal, rules: Iterable[KBRule]) -> bool:
+        return self.goal_tree.can_reach_goal_by_rules(goal, rules)
 
     def request_best_subgoal_value(self, goal: Goal):
         best_subgoal = goal.get_best_subgoal(self)
@@ -181,7 +327,7 @@ class Solver:
             return res
 
     def make_step_backward(self) -> Union[SelectGoalStep, ReachGoalStep]:
-        all_conflict_rules = self.match_forward()
+        all_conflict_rules = self.iter_forward_matches()
         current_goal_stack = [g for g in self.goal_stack]
         current_goal = self.goal_stack[-1]
 
@@ -193,14 +339,14 @@ class Solver:
         current_goal_rules = self.get_rules_deducting_goal(current_goal)
         step = None
         if self.goal_is_reached(current_goal):
-            step = SelectGoalStep(self.wm)
+            step = SelectGoalStep(self.trace, self.wm)
             step.current_goal_stack = [g for g in self.goal_stack]
             if self.goal_stack:
                 self.goal_stack.pop()
             if len(self.goal_stack):
                 step.final_goal = self.goal_stack[-1]
         if len(current_goal_rules):
-            step = ReachGoalStep(self.wm)
+            step = ReachGoalStep(self.trace, self.wm)
             step.current_goal_stack = [g for g in self.goal_stack]
             step.current_goal = current_goal
             step.conflict_rules = self.match_backward(current_goal_rules)
@@ -209,14 +355,14 @@ class Solver:
                 step.selected_rule.evaluated_condition.to_representation()
             ).to_internal(Context(name="trace"))
             self.fire_rule(step.selected_rule)
-            step.fired_rules = self.fired_rules + [step.selected_rule]
+            step.fired_rules = self.trace.fire(step.selected_rule)
             step.final_wm_state = self.wm
             if self.goal_stack:
                 self.goal_stack.pop()
             if len(self.goal_stack):
                 step.final_goal = self.goal_stack[-1]
         else:
-            step = SelectGoalStep(self.wm)
+            step = SelectGoalStep(self.trace, self.wm)
             step.current_goal_stack = [g for g in self.goal_stack]
             subgoals = [
                 g for g in current_goal.subgoals if not self.goal_in_stack(g) and not self.goal_is_watched(self)
@@ -238,45 +384,69 @@ class Solver:
         step.current_goal_stack = current_goal_stack
         return step
 
-    def run_backward(self) -> Trace:
-        self.trace.steps = []
-        self.goal_stack = [g for g in self.goals]
-        self.goal_stack.sort(key=lambda g: len(g.subgoals))
-        self._watched_goals = []
-
-        while len(self.goal_stack):
-            step = self.make_step_backward()
-            self.trace.steps.append(step)
-
+    def run_backward(self, trace_level: str = None) -> Trace:
+        self.start(trace_level)
+        try:
+            self.goal_stack = [g for g in self.goals]
+            self.goal_stack.sort(key=lambda g: len(g.subgoals))
+            self._watched_goals = []
+
+            while len(self.goal_stack):
+                step = self.make_step_backward()
+                self.trace.add_step(step)
+        finally:
+            self.finish()
         return self.trace
 
     def make_step_mixed(self) -> Union[ForwardStep, SelectGoalStep, ReachGoalStep]:
-        conflict_rules = self.match_forward()
-        if conflict_rules:
+        if self.has_forward_match():
             return self.make_step_forward()
         else:
             return self.make_step_backward()
 
-    def run_mixed(self) -> Trace:
-        self.trace.steps = []
-        self.goal_stack = [g for g in self.goals]
-        self.goal_stack.sort(key=lambda g: len(g.subgoals))
-        self._watched_goals = []
-        while len(self.match_forward()) or (len(self.goal_stack)):
-            step = self.make_step_mixed()
-            self.trace.steps.append(step)
+    def run_mixed(self, trace_level: str = None) -> Trace:
+        self.start(trace_level)
+        try:
+            self.goal_stack = [g for g in self.goals]
+            self.goal_stack.sort(key=lambda g: len(g.subgoals))
+            self._watched_goals = []
+            while self.has_forward_match() or len(self.goal_stack):
+                step = self.make_step_mixed()
+                self.trace.add_step(step)
+        finally:
+            self.finish()
         return self.trace
 
+    async def arequest_value(self, goal: Goal):
+        res = self.on_request_value(goal.ref.krl)
+        if inspect.iscoroutine(res):
+            res = await res
+        return res
+
     async def arequest_best_subgoal_value(self, goal: Goal):
         best_subgoal = goal.get_best_subgoal(self)
         if self.on_request_value is not None and callable(self.on_request_value):
-            res = self.on_request_value(best_subgoal.ref.krl)
-            if inspect.iscoroutine(res):
-                res = await res
-            return res
+            if self.prefetch_concurrency > 0:
+                return await self.aprefetch_subgoal_values(goal, best_subgoal)
+            return await self.arequest_value(best_subgoal)
+
+    async def aprefetch_subgoal_values(self, goal: Goal, best_subgoal: Goal) -> list:
+        """Requests the best subgoal concurrently with the other leaves the rules reading it need to reach the goal.
+
+        Leaves read only by alternative rules are not requested, since serial backward chaining may never ask
+        for them, and every request can be a question to the user.
+        """
+        subgoals = self.goal_tree.get_required_leaf_subgoals(goal, best_subgoal, self.goal_is_reached)
+        semaphore = asyncio.Semaphore(self.prefetch_concurrency)
+
+        async def request(subgoal: Goal):
+            async with semaphore:
+                return await self.arequest_value(subgoal)
+
+        return await asyncio.gather(*(request(subgoal) for subgoal in subgoals))
 
     async def amake_step_backward(self):
-        all_conflict_rules = self.match_forward()
+        all_conflict_rules = self.iter_forward_matches()
         current_goal = self.goal_stack[-1]
 
         if not self.goal_is_reached(current_goal) and not self.can_reach_goal_by_rules(
@@ -287,14 +457,14 @@ class Solver:
         current_goal_rules = self.get_rules_deducting_goal(current_goal)
         step = None
         if self.goal_is_reached(current_goal):
-            step = SelectGoalStep(self.wm)
+            step = SelectGoalStep(self.trace, self.wm)
             step.current_goal_stack = [g for g in self.goal_stack]
             if self.goal_stack:
                 self.goal_stack.pop()
             if len(self.goal_stack):
                 step.final_goal = self.goal_stack[-1]
         if len(current_goal_rules):
-            step = ReachGoalStep(self.wm)
+            step = ReachGoalStep(self.trace, self.wm)
             step.current_goal_stack = [g for g in self.goal_stack]
             step.current_goal = current_goal
             step.conflict_rules = self.match_backward(current_goal_rules)
@@ -303,14 +473,14 @@ class Solver:
                 **step.selected_rule.evaluated_condition.to_representation()
             ).to_internal(Context(name="trace"))
             self.fire_rule(step.selected_rule)
-            step.fired_rules = self.fired_rules + [step.selected_rule]
+            step.fired_rules = self.trace.fire(step.selected_rule)
             step.final_wm_state = self.wm
             if self.goal_stack:
                 self.goal_stack.pop()
             if len(self.goal_stack):
                 step.final_goal = self.goal_stack[-1]
         else:
-            step = SelectGoalStep(self.wm)
+            step = SelectGoalStep(self.trace, self.wm)
             step.current_goal_stack = [g for g in self.goal_stack]
             subgoals = [
                 g for g in current_goal.subgoals if not self.goal_in_stack(g) and not self.goal_is_watched(self)
@@ -328,56 +498,95 @@ class Solver:
         step.final_goal_stack = [g for g in self.goal_stack]
         return step
 
-    async def arun_backward(self) -> Trace:
-        self.trace.steps = []
-        self.goal_stack = [g for g in self.goals]
-        self.goal_stack.sort(key=lambda g: len(g.subgoals))
-        self._watched_goals = []
-
-        while len(self.goal_stack):
-            step = await self.amake_step_backward()
-            self.trace.steps.append(step)
-
+    async def arun_backward(self, trace_level: str = None) -> Trace:
+        self.start(trace_level)
+        try:
+            self.goal_stack = [g for g in self.goals]
+            self.goal_stack.sort(key=lambda g: len(g.subgoals))
+            self._watched_goals = []
+
+            while len(self.goal_stack):
+                step = await self.amake_step_backward()
+                self.trace.add_step(step)
+        finally:
+            self.finish()
         return self.trace
 
     async def amake_step_mixed(self) -> Union[ForwardStep, SelectGoalStep, ReachGoalStep]:
-        conflict_rules = self.match_forward()
-        if conflict_rules:
+        if self.has_forward_match():
             return self.make_step_forward()
         else:
             return await self.amake_step_backward()
 
-    async def arun_mixed(self) -> Trace:
-        self.trace.steps = []
-        self.goal_stack = [g for g in self.goals]
-        self.goal_stack.sort(key=lambda g: len(g.subgoals))
-        self._watched_goals = []
-        while len(self.match_forward()) or (len(self.goal_stack)):
-            step = await self.amake_step_mixed()
-            self.trace.steps.append(step)
+    async def arun_mixed(self, trace_level: str = None) -> Trace:
+        self.start(trace_level)
+        try:
+            self.goal_stack = [g for g in self.goals]
+            self.goal_stack.sort(key=lambda g: len(g.subgoals))
+            self._watched_goals = []
+            while self.has_forward_match() or len(self.goal_stack):
+                step = await self.amake_step_mixed()
+                self.trace.add_step(step)
+        finally:
+            self.finish()
         return self.trace
 
-    async def run(self) -> Trace:
+    async def run(self, trace_level: str = None) -> Trace:
         if self.mode == SOLVER_MODE.forwards:
-            return self.run_forward()
+            return self.run_forward(trace_level=trace_level)
         elif self.mode == SOLVER_MODE.backwards:
-            return self.arun_backward()
+            return await self.arun_backward(trace_level=trace_level)
         elif self.mode == SOLVER_MODE.mixed:
-            return self.arun_mixed()
+            return await self.arun_mixed(trace_level=trace_level)
 
     def fire_rule(self, rule: KBRule):
         if rule.evaluated_condition.content:
             for instruction in rule.instructions:
-                self.interprite_instruction(instruction)
+                self.interprite_instruction(instruction, rule.evaluated_condition)
         elif rule.else_instructions:
             for instruction in rule.else_instructions:
-                self.interprite_instruction(instruction)
+                self.interprite_instruction(instruction, rule.evaluated_condition)
 
-    def interprite_instruction(self, instruction: KBInstruction):
+    def interprite_instruction(self, instruction: KBInstruction, condition: KBValue = None):
         if isinstance(instruction, AssignInstruction):
-            self.interprite_assign(instruction)
-
-    def interprite_assign(self, instruction: AssignInstruction):
-        evaluator = BasicEvaluator(self.wm)
-        value = evaluator.eval(instruction.value)
+            self.interprite_assign(instruction, condition)
+
+    def interprite_assign(self, instruction: AssignInstruction, condition: KBValue = None):
+        value = self.expressions.eval(instruction.value, self.wm)
+        if self.evaluator == SOLVER_EVALUATOR.fuzzy and condition is not None:
+            value = self.conclude_fuzzy(instruction, value, condition)
+        elif self.non_factors is not None and condition is not None:
+            value = self.conclude(instruction, value, condition)
+        else:
+            value = materialize(value)
         self.wm.set_value(instruction.ref, value)
+
+    def conclude_fuzzy(self, instruction: AssignInstruction, value: KBValue, condition: KBValue) -> KBValue:
+        """Crisp value of a fuzzy property from the terms concluded during the run.
+
+        Degrees of the same term concluded by several rules are aggregated by max, the value is the centroid.
+        Values of other properties are assigned as they are.
+        """
+        key = reference_key(instruction.ref)
+        variable = self.expressions.model.variables.get(key)
+        if variable is None or not isinstance(value.content, str):
+            return materialize(value)
+        degree = FuzzyEvaluator.get_degree(condition)
+        if not condition.content:
+            degree = 1.0 - (degree or 0.0)
+        degrees = self.fuzzy_conclusions.setdefault(key, {})
+        degrees[value.content] = max(degrees.get(value.content, 0.0), degree or 0.0)
+        crisp = variable.defuzzify(degrees)
+        if crisp is None:
+            return materialize(value)
+        return KBValue(content=crisp, non_factor=NonFactor())
+
+    def conclude(self, instruction: AssignInstruction, value: KBValue, condition: KBValue) -> KBValue:
+        """Value with the non-factor of the rule conclusion, combined with the same value assigned before."""
+        non_factor = self.non_factors.conclude(
+            get_non_factor(value), get_non_factor(condition), getattr(instruction, "non_factor", None)
+        )
+        old = self.wm.get_value(instruction.ref)
+        if isinstance(old, KBValue) and old.non_factor is not None and old.content == value.content:
+            non_factor = self.non_factors.combine(old.non_factor, non_factor)
+        return KBValue(content=value.content, non_factor=non_factor)
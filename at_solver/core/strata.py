@@ -0,0 +1,44 @@
+from typing import Dict
+from typing import List
+from typing import Set
+
+from at_solver.core.dependencies import ordered_components
+from at_solver.core.goals import GoalTreeMap
+
+
+class RuleStrata:
+    """Rule dependency graph of a knowledge base split into strata.
+
+    A rule depends on another rule when it reads (in condition or in assigned values) a property the other rule
+    assigns. Strata are strongly connected components of the graph in topological order, so no rule can change
+    what the rules of earlier strata read.
+    A stratum is cyclic when its rules depend on each other (or a rule depends on itself).
+    """
+
+    goal_tree: GoalTreeMap
+    graph: Dict[int, List[int]]
+    components: List[List[int]]
+    _cyclic: Set[int]
+
+    def __init__(self, goal_tree: GoalTreeMap) -> None:
+        self.goal_tree = goal_tree
+        self.graph = {ordinal: [] for ordinal in range(len(goal_tree.rules))}
+        for ordinal, rule in enumerate(goal_tree.rules):
+            writers = set()
+            for key in goal_tree.get_rule_read_keys(rule):
+                writers.update(goal_tree.instructions_index.get(key, ()))
+                writers.update(goal_tree.else_instructions_index.get(key, ()))
+            for writer in sorted(writers):
+                self.graph[writer].append(ordinal)
+        self.components = ordered_components(self.graph)
+        self._cyclic = set()
+        for number, component in enumerate(self.components):
+            if len(component) > 1 or component[0] in self.graph[component[0]]:
+                self._cyclic.add(number)
+
+    @property
+    def is_acyclic(self) -> bool:
+        return not self._cyclic
+
+    def is_cyclic(self, number: int) -> bool:
+        return number in self._cyclic
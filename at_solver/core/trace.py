@@ -1,62 +1,135 @@
+from bisect import bisect_right
+from typing import Dict
 from typing import List
+from typing import Sequence
+from typing import Set
+from typing import Union
 
 from at_krl.core.kb_rule import KBRule
 from at_krl.core.kb_value import KBValue
-from at_krl.models.kb_class import KBInstanceModel
-from at_krl.utils.context import Context
 
 from at_solver.core.goals import Goal
+from at_solver.core.references import reference_key
+from at_solver.core.wm import WMChange
 from at_solver.core.wm import WorkingMemory
 
 
+class FiredRulesView(Sequence[KBRule]):
+    """Prefix of the fired rules list as it was at some step."""
+
+    def __init__(self, rules: List[KBRule], count: int) -> None:
+        self._rules = rules
+        self._count = count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._rules[: self._count][index]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("fired rules index out of range")
+        return self._rules[index]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._rules[i]
+
+
+class FiredRules(Sequence[KBRule]):
+    """Append-only list of fired rules with constant time membership test by identity."""
+
+    def __init__(self) -> None:
+        self._rules = []
+        self._ids: Set[int] = set()
+
+    def append(self, rule: KBRule):
+        self._ids.add(id(rule))
+        self._rules.append(rule)
+
+    def view(self) -> FiredRulesView:
+        return FiredRulesView(self._rules, len(self._rules))
+
+    def __contains__(self, rule: KBRule) -> bool:
+        return id(rule) in self._ids
+
+    def __getitem__(self, index):
+        return self._rules[index]
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def __iter__(self):
+        return iter(self._rules)
+
+
+# number of journal entries between kept states of a full trace
+CHECKPOINT_INTERVAL = 64
+
+
+class TRACE_LEVEL:
+    off = "off"
+    summary = "summary"
+    full = "full"
+
+    @classmethod
+    def all(cls) -> List[str]:
+        return [cls.off, cls.summary, cls.full]
+
+
 class TraceStep:
-    initial_wm_state: WorkingMemory
+    _trace: "Trace"
+    _initial_position: int
 
-    def __init__(self, wm: WorkingMemory) -> None:
-        self.initial_wm_state = WorkingMemory(kb=wm.kb)
+    def __init__(self, trace: "Trace", wm: WorkingMemory) -> None:
+        self._trace = trace
+        self._initial_position = trace.position(wm)
 
-        self.initial_wm_state.locals = {
-            key: KBValue(content=v.content, non_factor=v.non_factor) if v is not None else KBValue(content=None)
-            for key, v in wm.locals.items()
-        }
+    @property
+    def initial_wm_state(self) -> WorkingMemory:
+        return self._trace.state_at(self._initial_position)
 
-        self.initial_wm_state.env = KBInstanceModel(**wm.env.to_representation()).to_internal(
-            Context(name="trace_step", kb=wm.kb)
-        )
+    @property
+    def has_wm_states(self) -> bool:
+        return self._trace.level == TRACE_LEVEL.full
 
     @property
     def __dict__(self):
-        return {"initial_wm_state": self.initial_wm_state.all_values_dict}
+        if self.has_wm_states:
+            return {"initial_wm_state": self.initial_wm_state.all_values_dict}
+        return {}
 
 
 class ForwardStep(TraceStep):
-    _final_wm_state: WorkingMemory
+    _final_position: int
     conflict_rules: List[KBRule]
     selected_rule: KBRule
-    fired_rules: List[KBRule]
+    fired_rules: Sequence[KBRule]
     rule_condition_value: KBValue = None
 
     @property
-    def final_wm_state(self):
-        return self._final_wm_state
+    def final_wm_state(self) -> WorkingMemory:
+        return self._trace.state_at(self._final_position)
 
     @final_wm_state.setter
     def final_wm_state(self, wm: WorkingMemory) -> None:
-        self._final_wm_state = WorkingMemory(kb=wm.kb)
+        self._final_position = self._trace.position(wm)
 
-        self._final_wm_state.locals = {
-            key: KBValue(content=v.content, non_factor=v.non_factor) if v is not None else KBValue(content=None)
-            for key, v in wm.locals.items()
-        }
+    @property
+    def changes(self) -> List[WMChange]:
+        return self._trace.changes_between(self._initial_position, self._final_position)
 
-        self._final_wm_state.env = KBInstanceModel(**wm.env.to_representation()).to_internal(
-            Context(name="trace_step", kb=wm.kb)
-        )
+    def _wm_states_or_changes_dict(self):
+        if self.has_wm_states:
+            return {"final_wm_state": self.final_wm_state.all_values_dict}
+        return {"changes": [reference_key(change.ref) for change in self.changes]}
 
     @property
     def __dict__(self):
         return {
-            "final_wm_state": self.final_wm_state.all_values_dict,
+            **self._wm_states_or_changes_dict(),
             "conflict_rules": [rule.id for rule in self.conflict_rules],
             "selected_rule": self.selected_rule.id,
             "fired_rules": [rule.id for rule in self.fired_rules],
@@ -94,9 +167,12 @@ class SelectGoalStep(BackwardStep):
 class ReachGoalStep(SelectGoalStep, ForwardStep):
     @property
     def __dict__(self):
+        states = {}
+        if self.has_wm_states:
+            states["initial_wm_state"] = self.initial_wm_state.all_values_dict
         return {
-            "initial_wm_state": self.initial_wm_state.all_values_dict,
-            "final_wm_state": self.final_wm_state.all_values_dict,
+            **states,
+            **self._wm_states_or_changes_dict(),
             "conflict_rules": [rule.id for rule in self.conflict_rules],
             "selected_rule": self.selected_rule.id,
             "fired_rules": [rule.id for rule in self.fired_rules],
@@ -109,10 +185,99 @@ class ReachGoalStep(SelectGoalStep, ForwardStep):
 
 
 class Trace:
+    """Steps of a solver run.
+
+    Working memory states of the steps are not copied. With the ``full`` level the trace keeps one base snapshot
+    of the working memory and a journal of the changes made after it; a step stores only its positions in the
+    journal, and its states are reconstructed when requested. A journal entry is either a ``WMChange`` or a full
+    snapshot, which is recorded when the working memory of the solver is replaced during a run. Reconstructed states
+    are kept as checkpoints every ``CHECKPOINT_INTERVAL`` journal entries, so a state is replayed from the nearest
+    checkpoint and reading the states of all steps is linear in the journal length.
+
+    The ``summary`` level journals changes without snapshots, so steps report only the changed references.
+    The ``off`` level records neither steps nor changes.
+    """
+
     steps: List[TraceStep]
+    fired_rules: FiredRules
+    level: str
+    _journal: List[Union[WMChange, WorkingMemory]]
+    _snapshots: List[int]
+    _checkpoints: Dict[int, WorkingMemory]
+    _wm: WorkingMemory = None
 
-    def __init__(self) -> None:
+    def __init__(self, level: str = None) -> None:
+        self.level = level or TRACE_LEVEL.full
+        self.reset()
+
+    def reset(self, wm: WorkingMemory = None, level: str = None):
+        if level is not None:
+            if level not in TRACE_LEVEL.all():
+                raise ValueError(f'Invalid trace level "{level}"')
+            self.level = level
         self.steps = []
+        self.fired_rules = FiredRules()
+        self._journal = []
+        self._snapshots = []
+        self._checkpoints = {}
+        self._wm = None
+        if wm is not None:
+            self.start(wm)
+
+    def start(self, wm: WorkingMemory):
+        self._wm = wm
+        self._journal = [wm.snapshot()] if self.level == TRACE_LEVEL.full else []
+        self._snapshots = [0] if self.level == TRACE_LEVEL.full else []
+        self._checkpoints = {}
+
+    def finish(self):
+        """Stops journaling, steps taken afterwards continue the journal from a new snapshot."""
+        self._wm = None
+
+    def add_step(self, step: TraceStep):
+        if self.level != TRACE_LEVEL.off:
+            self.steps.append(step)
+
+    def record(self, change: WMChange):
+        if self._wm is not None and self.level != TRACE_LEVEL.off:
+            self._journal.append(change)
+
+    def position(self, wm: WorkingMemory) -> int:
+        if self.level == TRACE_LEVEL.off:
+            return 0
+        if self._wm is None and not self.steps:
+            self.start(wm)
+        elif self._wm is not wm:
+            self._wm = wm
+            if self.level == TRACE_LEVEL.full:
+                self._snapshots.append(len(self._journal))
+                self._journal.append(wm.snapshot())
+        return len(self._journal)
+
+    def changes_between(self, start: int, end: int) -> List[WMChange]:
+        return [entry for entry in self._journal[start:end] if isinstance(entry, WMChange)]
+
+    def state_at(self, position: int) -> WorkingMemory:
+        if self.level != TRACE_LEVEL.full:
+            raise ValueError(f'Working memory states are not recorded with trace level "{self.level}"')
+        base_position = self._snapshots[bisect_right(self._snapshots, position - 1) - 1]
+        start, source = base_position + 1, self._journal[base_position]
+        checkpoint = position - position % CHECKPOINT_INTERVAL
+        while checkpoint > start and checkpoint not in self._checkpoints:
+            checkpoint -= CHECKPOINT_INTERVAL
+        if checkpoint > start:
+            start, source = checkpoint, self._checkpoints[checkpoint]
+        state = source.fork()
+        for index in range(start, position):
+            change = self._journal[index]
+            state.restore_value(change.path, change.new)
+            if (index + 1) % CHECKPOINT_INTERVAL == 0:
+                self._checkpoints.setdefault(index + 1, state.snapshot())
+        return state
+
+    def fire(self, rule: KBRule) -> FiredRulesView:
+        self.fired_rules.append(rule)
+        return self.fired_rules.view()
 
     @property
     def __dict__(self):
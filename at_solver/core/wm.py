@@ -1,8 +1,19 @@
+import copy
+import itertools
 import logging
+import sys
+import weakref
 from dataclasses import dataclass
 from dataclasses import field
 from typing import Any
+from typing import Callable
+from typing import ClassVar
 from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Sequence
+from typing import Tuple
 from typing import TypedDict
 from typing import Union
 
@@ -14,10 +25,17 @@ from at_krl.core.kb_reference import KBReference
 from at_krl.core.kb_type import KBType
 from at_krl.core.kb_value import KBValue
 from at_krl.core.knowledge_base import KnowledgeBase
+from at_krl.core.non_factor import NonFactor
 from at_krl.core.simple.simple_reference import SimpleReference
 from at_krl.core.simple.simple_value import SimpleValue
 
+from at_solver.core.dependencies import find_cycles
+from at_solver.core.dependencies import strongly_connected_components
+from at_solver.core.references import get_reference_keys
+from at_solver.core.references import reference_key
+from at_solver.core.references import ReferenceCache
 from at_solver.evaluations.basic import BasicEvaluator
+from at_solver.evaluations.basic import materialize
 
 logger = logging.getLogger(__name__)
 
@@ -33,11 +51,163 @@ class KBValueDict(TypedDict):
     non_factor: Union[NonFactorDict, None]
 
 
+class WMChange(NamedTuple):
+    ref: SimpleReference
+    path: Union[str, SimpleReference]
+    old: Union[SimpleValue, None]
+    new: SimpleValue
+
+
+class WMUpdate(NamedTuple):
+    path: str
+    content: Union[str, int, float, bool, None]
+    belief: Union[int, float] = 50
+    probability: Union[int, float] = 100
+    accuracy: Union[int, float] = 0
+
+
+class WorkingMemoryPrototype:
+    """Slot layout and evaluated default values of the working memory of a knowledge base.
+
+    The prototype is built once per knowledge base from the first created ``env``. New working memories start
+    from its ``defaults`` and clone its instances in slot order when ``env`` is requested, instead of
+    instantiating the world class and evaluating default values again. Default values are shared between
+    working memories, which replace values on assignment and never mutate them.
+
+    Default value expressions are evaluated once, after the slot layout is built, in the order of their
+    dependencies. Properties whose defaults depend on each other are reported in ``value_cycles`` and their
+    defaults stay unknown.
+    """
+
+    _registry: ClassVar[Dict[int, Tuple[Any, "WorkingMemoryPrototype"]]] = {}
+
+    env: KBInstance
+    keys: List[str]
+    slot_index: Dict[str, int]
+    defaults: List[Union[SimpleValue, None]]
+    base: List[Tuple[Union[SimpleValue, None], int]]
+    references: ReferenceCache
+    default_dependencies: Dict[str, List[str]]
+    value_cycles: List[List[str]]
+    _nodes: List[Tuple[KBInstance, int]]
+
+    def __init__(self, env: KBInstance) -> None:
+        self.keys = []
+        self.slot_index = {}
+        self._nodes = []
+        self.references = ReferenceCache()
+        self.env = env
+        self._flatten(env.properties, None, -1)
+        # detach the template from the given tree, which belongs to a working memory
+        self.env, slots = self.instantiate()
+        self._nodes = [(slot, parent) for slot, (_, parent) in zip(slots, self._nodes)]
+        self.defaults = [getattr(instance, "value", None) for instance in slots]
+        self.base = [(default, 0) for default in self.defaults]
+        self.default_dependencies = self.get_default_dependencies()
+        self.value_cycles = find_cycles(self.default_dependencies)
+
+    def _flatten(self, properties: List[KBInstance], owner_key: Union[str, None], parent: int):
+        for prop in properties or []:
+            key = sys.intern(prop.id if owner_key is None else owner_key + "." + prop.id)
+            slot = len(self._nodes)
+            self.keys.append(key)
+            self.slot_index[key] = slot
+            self._nodes.append((prop, parent))
+            self._flatten(prop.properties, key, slot)
+
+    def get_default_dependencies(self) -> Dict[str, List[str]]:
+        """Keys of the slots read by the default value expression of each slot."""
+        dependencies = {}
+        for key, (instance, _) in zip(self.keys, self._nodes):
+            default = getattr(getattr(instance, "definition", None), "value", None)
+            dependencies[key] = get_reference_keys(default)
+        return dependencies
+
+    def evaluate_defaults(self, wm: "WorkingMemory") -> None:
+        """Evaluates default value expressions in the working memory built on this prototype.
+
+        A default is evaluated after the defaults it reads, defaults in ``value_cycles`` are not evaluated.
+        """
+        cyclic = {key for cycle in self.value_cycles for key in cycle}
+        evaluator = BasicEvaluator(wm)
+        for component in strongly_connected_components(self.default_dependencies):
+            for key in component:
+                slot = self.slot_index.get(key)
+                if slot is None or key in cyclic:
+                    continue
+                instance = self._nodes[slot][0]
+                default = getattr(getattr(instance, "definition", None), "value", None)
+                if default:
+                    instance.value = self.defaults[slot] = materialize(evaluator.eval(default))
+                    self.base[slot] = (instance.value, 0)
+
+    @property
+    def flatten_threshold(self) -> int:
+        return max(32, len(self.keys) // 8)
+
+    @staticmethod
+    def _clone(instance: KBInstance) -> KBInstance:
+        clone = copy.copy(instance)
+        if isinstance(instance.properties, list):
+            clone.properties = []
+        return clone
+
+    def instantiate(self) -> Tuple[KBInstance, List[KBInstance]]:
+        env = self._clone(self.env)
+        slots = []
+        for node, parent in self._nodes:
+            instance = self._clone(node)
+            owner = env if parent < 0 else slots[parent]
+            instance.owner = owner
+            owner.properties.append(instance)
+            slots.append(instance)
+        return env, slots
+
+    @classmethod
+    def get(cls, kb: KnowledgeBase) -> Union["WorkingMemoryPrototype", None]:
+        registered = cls._registry.get(id(kb))
+        if registered is not None:
+            kb_ref, prototype = registered
+            if (kb_ref() if isinstance(kb_ref, weakref.ref) else kb_ref) is kb:
+                return prototype
+
+    @classmethod
+    def register(cls, kb: KnowledgeBase, prototype: "WorkingMemoryPrototype") -> "WorkingMemoryPrototype":
+        key = id(kb)
+        try:
+            kb_ref = weakref.ref(kb, lambda _: cls._registry.pop(key, None))
+        except TypeError:
+            kb_ref = kb
+        cls._registry[key] = (kb_ref, prototype)
+        return prototype
+
+
+# versions of slots are stamps of one counter, so equal versions mean equal values in any working memory of a kb
+_VERSION_STAMPS = itertools.count(1)
+
+
 @dataclass(kw_only=True)
 class WorkingMemory:
-    env: KBInstance = field(init=False)
-    locals: Dict[str, KBValue] = field(init=False, default_factory=dict)
+    """Values of the world class instance and local values.
+
+    Values are kept in slots laid out by the ``WorkingMemoryPrototype`` of the knowledge base: an immutable
+    ``_base`` list that can be shared with forks, and an ``_overlay`` of slots written since. Both hold
+    ``(value, version)`` pairs. A fork shares both until its first write, which copies only the overlay. The
+    overlay is merged into a new base list when it grows. The ``env`` instance tree is a view that is built on the
+    first request and kept in sync afterwards.
+    """
+
     kb: KnowledgeBase
+    _prototype: WorkingMemoryPrototype = field(init=False, default=None, repr=False)
+    _base: List[Tuple[Union[SimpleValue, None], int]] = field(init=False, default=None, repr=False)
+    _overlay: Dict[int, Tuple[Union[SimpleValue, None], int]] = field(init=False, default_factory=dict, repr=False)
+    _overlay_shared: bool = field(init=False, default=False, repr=False)
+    _locals: Dict[str, KBValue] = field(init=False, default_factory=dict, repr=False)
+    _locals_shared: bool = field(init=False, default=False, repr=False)
+    _env: KBInstance = field(init=False, default=None, repr=False)
+    _env_slots: List[Union[KBInstance, None]] = field(init=False, default=None, repr=False)
+    _instance_slots: Dict[int, int] = field(init=False, default=None, repr=False)
+    _listeners: List[Callable[[WMChange], None]] = field(init=False, default_factory=list, repr=False)
 
     def create_instance(
         self,
@@ -46,6 +216,7 @@ class WorkingMemory:
         desc: str = None,
         evaluator: BasicEvaluator | None = None,
         as_property: bool = False,
+        with_defaults: bool = True,
     ) -> KBInstance:
         evaluator = evaluator or BasicEvaluator(self)
         type = TypeOrClassReference(id=kb_class.id)
@@ -63,19 +234,212 @@ class WorkingMemory:
                     )
                 if isinstance(prop_def.type.target, KBClass):
                     prop = self.create_instance(
-                        id=prop_def.id, kb_class=prop_def.type.target, evaluator=evaluator, as_property=True
+                        id=prop_def.id,
+                        kb_class=prop_def.type.target,
+                        evaluator=evaluator,
+                        as_property=True,
+                        with_defaults=with_defaults,
                     )
                 else:
                     prop = KBProperty(id=prop_def.id, type=prop_def.type)
-                    if prop_def.value:
-                        prop.value = evaluator.eval(prop_def.value)
+                    if prop_def.value and with_defaults:
+                        prop.value = materialize(evaluator.eval(prop_def.value))
                 prop.definition = prop_def
                 prop.owner = instance
                 instance.properties.append(prop)
         return instance
 
     def __post_init__(self):
-        self.env = self.create_instance("env", self.kb.world)
+        prototype = WorkingMemoryPrototype.get(self.kb)
+        registered = prototype is not None
+        if not registered:
+            prototype = WorkingMemoryPrototype(self.create_instance("env", self.kb.world, with_defaults=False))
+        self._prototype = prototype
+        self._base = prototype.base
+        if not registered:
+            # defaults read other slots, so they are evaluated in this working memory once the layout is built
+            prototype.evaluate_defaults(self)
+            WorkingMemoryPrototype.register(self.kb, prototype)
+
+    def fork(self) -> "WorkingMemory":
+        """Independent working memory with the same values. Slots and locals are shared until written."""
+        wm = WorkingMemory(kb=self.kb)
+        wm._base = self._base
+        wm._overlay = self._overlay
+        wm._overlay_shared = self._overlay_shared = True
+        wm._locals = self._locals
+        wm._locals_shared = self._locals_shared = True
+        return wm
+
+    def snapshot(self) -> "WorkingMemory":
+        """Copy of the current state that is not affected by further changes of this working memory."""
+        return self.fork()
+
+    @property
+    def env(self) -> KBInstance:
+        if self._env is None:
+            env, slots = self._prototype.instantiate()
+            for slot, instance in enumerate(slots):
+                value = self.get_slot_value(slot)
+                if value is not getattr(instance, "value", None):
+                    instance.value = value
+            self._set_env_slots(env, slots)
+        return self._env
+
+    @env.setter
+    def env(self, env: KBInstance):
+        slots = [None] * len(self._prototype.keys)
+        base = list(self._prototype.defaults)
+        stack = [(prop, prop.id) for prop in reversed(env.properties or [])]
+        while stack:
+            instance, key = stack.pop()
+            slot = self._prototype.slot_index.get(key)
+            if slot is not None:
+                slots[slot] = instance
+                base[slot] = getattr(instance, "value", None)
+            for prop in reversed(instance.properties or []):
+                stack.append((prop, key + "." + prop.id))
+        self._base = [(value, next(_VERSION_STAMPS)) for value in base]
+        self._overlay = {}
+        self._overlay_shared = False
+        self._set_env_slots(env, slots)
+        for slot, (value, _) in enumerate(self._base):
+            if self.is_expression(value):
+                self.check_recursive_links(slot, value)
+
+    def _set_env_slots(self, env: KBInstance, slots: List[Union[KBInstance, None]]):
+        self._env = env
+        self._env_slots = slots
+        self._instance_slots = {id(instance): slot for slot, instance in enumerate(slots) if instance is not None}
+
+    @property
+    def locals(self) -> Dict[str, KBValue]:
+        if self._locals_shared:
+            self._locals = dict(self._locals)
+            self._locals_shared = False
+        return self._locals
+
+    @locals.setter
+    def locals(self, value: Dict[str, KBValue]):
+        self._locals = value
+        self._locals_shared = False
+
+    def get_local(self, key: str) -> Union[KBValue, None]:
+        return self._locals.get(key)
+
+    def subscribe(self, listener: Callable[[WMChange], None]):
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[WMChange], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def notify(self, change: WMChange):
+        for listener in self._listeners:
+            listener(change)
+
+    @property
+    def slot_keys(self) -> List[str]:
+        """Keys of the slots in slot order."""
+        return self._prototype.keys
+
+    def get_slot_by_key(self, key: str) -> Union[int, None]:
+        return self._prototype.slot_index.get(key)
+
+    def get_slot(self, ref: SimpleReference) -> Union[int, None]:
+        return self.get_slot_by_key(reference_key(ref))
+
+    def _get_entry(self, slot: int) -> Tuple[Union[SimpleValue, None], int]:
+        entry = self._overlay.get(slot)
+        if entry is None:
+            return self._base[slot]
+        return entry
+
+    def get_slot_value(self, slot: int) -> Union[SimpleValue, None]:
+        return self._get_entry(slot)[0]
+
+    def get_version(self, slot: int) -> int:
+        """Version of the slot value, which changes on every write. Unchanged defaults have version 0."""
+        return self._get_entry(slot)[1]
+
+    def get_versions(self, keys: Sequence[str]) -> Union[Tuple[int, ...], None]:
+        """Versions of the slots with the keys.
+
+        None when one of the keys is not a slot or a slot holds an expression, which depends on other values.
+        """
+        versions = []
+        for key in keys:
+            slot = self._prototype.slot_index.get(key)
+            if slot is None:
+                return None
+            value, version = self._get_entry(slot)
+            if self.is_expression(value):
+                return None
+            versions.append(version)
+        return tuple(versions)
+
+    @staticmethod
+    def is_expression(value: Any) -> bool:
+        return value is not None and not isinstance(value, (KBValue, SimpleValue))
+
+    def get_templates(self) -> List[Tuple[str, KBInstance]]:
+        """Keys of the slots with the instances they were created from, which hold the property types."""
+        return [(key, instance) for key, (instance, _) in zip(self._prototype.keys, self._prototype._nodes)]
+
+    @property
+    def default_dependencies(self) -> Dict[str, List[str]]:
+        """Keys of the slots read by the default value expression of each slot."""
+        return self._prototype.default_dependencies
+
+    @property
+    def value_cycles(self) -> List[List[str]]:
+        """Groups of properties whose default values depend on each other, found when the knowledge base is loaded."""
+        return self._prototype.value_cycles
+
+    def check_recursive_links(self, slot: int, value: Any):
+        """Raises ValueError if the expression value would make the slot read itself through other slots."""
+        target = self._prototype.keys[slot]
+        stack = get_reference_keys(value)
+        seen = set()
+        while stack:
+            key = stack.pop()
+            if key == target:
+                raise ValueError(f"Reference {target} has recursive link in wm to evaluate")
+            if key in seen:
+                continue
+            seen.add(key)
+            linked = self.get_slot_by_key(key)
+            if linked is not None and self.is_expression(self.get_slot_value(linked)):
+                stack.extend(get_reference_keys(self.get_slot_value(linked)))
+
+    def set_slot_value(self, slot: int, value: SimpleValue):
+        if self.is_expression(value):
+            self.check_recursive_links(slot, value)
+        if self._overlay_shared:
+            self._overlay = dict(self._overlay)
+            self._overlay_shared = False
+        self._overlay[slot] = (value, next(_VERSION_STAMPS))
+        if len(self._overlay) > self._prototype.flatten_threshold:
+            base = list(self._base)
+            for s, entry in self._overlay.items():
+                base[s] = entry
+            self._base = base
+            self._overlay = {}
+        if self._env_slots is not None and self._env_slots[slot] is not None:
+            self._env_slots[slot].value = value
+
+    def get_instance_by_key(self, key: str) -> Union[KBInstance, None]:
+        slot = self.get_slot_by_key(key)
+        if slot is not None:
+            self.env
+            return self._env_slots[slot]
+
+    def parse_reference(self, path: str) -> KBReference:
+        return self._prototype.references.parse(path)
+
+    def reference_krl(self, ref: SimpleReference) -> str:
+        return self._prototype.references.krl(ref)
 
     def set_value(self, path: str | SimpleReference, value: SimpleValue | Any):
         v = value
@@ -83,29 +447,42 @@ class WorkingMemory:
             v = KBValue(content=v)
         if isinstance(path, SimpleReference):
             ref = path
+            key = reference_key(ref)
         else:
-            ref = KBReference.from_simple(KBReference.parse(path))
-        if self.ref_is_accessible(ref):
-            self.set_value_by_ref(ref, v)
+            ref, key = self._prototype.references.resolve(path)
+        slot = self.get_slot_by_key(key)
+        if slot is not None:
+            old = self.get_slot_value(slot)
+            self.set_slot_value(slot, v)
+            self.notify(WMChange(ref=ref, path=ref, old=old, new=v))
         else:
             key = path
             if isinstance(path, SimpleReference):
-                key = path.to_simple().krl
+                key = self.reference_krl(path)
+            old = self._locals.get(key)
             self.locals[key] = v
+            self.notify(WMChange(ref=ref, path=path, old=old, new=v))
 
     def ref_is_accessible(self, ref: KBReference):
-        return self.get_instance_by_ref(ref) is not None
+        return self.get_slot(ref) is not None
 
     def set_value_by_ref(self, ref: KBReference, value: SimpleValue):
-        inst = self.get_instance_by_ref(ref)
-        return self.assign_value(inst, value)
+        slot = self.get_slot(ref)
+        old = self.get_slot_value(slot)
+        self.set_slot_value(slot, value)
+        self.notify(WMChange(ref=ref, path=ref, old=old, new=value))
 
     def assign_value(self, inst: KBInstance, value: SimpleValue) -> KBInstance:
-        inst.value = value
+        slot = self._instance_slots.get(id(inst)) if self._instance_slots is not None else None
+        if slot is not None:
+            self.set_slot_value(slot, value)
+        else:
+            inst.value = value
         return inst
 
     def get_instance_by_ref(self, ref: KBReference, env: KBInstance = None) -> KBInstance:
-        env = env or self.env
+        if env is None or env is self._env:
+            return self.get_instance_by_key(reference_key(ref))
         if ref.fullfiled:
             if ref.ref is None:
                 return ref.target
@@ -118,20 +495,118 @@ class WorkingMemory:
                 return prop
 
     def get_value_by_ref(self, ref: KBReference, env: KBInstance = None) -> KBValue:
-        env = env or self.env
-        instance = self.get_instance_by_ref(ref, env)
-        if instance is not None:
-            return instance.value
-        return self.locals.get(ref.to_simple().krl)
+        if env is None or env is self._env:
+            slot = self.get_slot(ref)
+            if slot is not None:
+                return self.get_slot_value(slot)
+        else:
+            instance = self.get_instance_by_ref(ref, env)
+            if instance is not None:
+                return instance.value
+        return self._locals.get(self.reference_krl(ref))
 
     def get_value(self, path: SimpleReference | str, env: KBInstance = None) -> KBValue:
-        env = env or self.env
-
         ref = path
         if not isinstance(path, SimpleReference):
-            ref = KBReference.parse(path)
+            ref = self.parse_reference(path)
         return self.get_value_by_ref(ref, env)
 
+    def restore_value(self, path: str | SimpleReference, value: Union[SimpleValue, None]):
+        """Puts the recorded value back as is, without notifications. ``None`` removes a local value."""
+        if isinstance(path, SimpleReference):
+            ref = path
+            key = reference_key(ref)
+        else:
+            ref, key = self._prototype.references.resolve(path)
+        slot = self.get_slot_by_key(key)
+        if slot is not None:
+            self.set_slot_value(slot, value)
+            return
+        if isinstance(path, SimpleReference):
+            path = self.reference_krl(path)
+        if value is None:
+            self.locals.pop(path, None)
+        else:
+            self.locals[path] = value
+
+    @staticmethod
+    def value_equals(value: Union[SimpleValue, None], update: WMUpdate) -> bool:
+        if not isinstance(value, KBValue):
+            return False
+        content = value.content
+        if type(content) is not type(update.content) or content != update.content:
+            return False
+        nf = value.non_factor
+        if nf is None:
+            return False
+        return nf.belief == update.belief and nf.probability == update.probability and nf.accuracy == update.accuracy
+
+    def update_values(self, updates: Iterable[WMUpdate], clear_before: bool = False) -> List[str]:
+        """Applies a batch of values and returns the paths of the changed ones.
+
+        Values equal to the current ones (by content and non-factor) are skipped without allocations and
+        notifications. With ``clear_before`` the values missing from the batch are reset to their defaults and
+        local values missing from the batch are removed, which is the same result as updating a new working memory.
+        """
+        changed = []
+        references = self._prototype.references
+        updated_slots = set()
+        updated_locals = set()
+        for update in updates:
+            ref, key = references.resolve(update.path)
+            slot = self.get_slot_by_key(key)
+            if slot is not None:
+                updated_slots.add(slot)
+                current = self.get_slot_value(slot)
+            else:
+                updated_locals.add(update.path)
+                current = self._locals.get(update.path)
+            if self.value_equals(current, update):
+                continue
+            value = KBValue(
+                content=update.content,
+                non_factor=NonFactor(belief=update.belief, probability=update.probability, accuracy=update.accuracy),
+            )
+            self.set_value(update.path, value)
+            changed.append(update.path)
+
+        if clear_before:
+            for slot, key in enumerate(self._prototype.keys):
+                if slot not in updated_slots and self._reset_slot(slot, key):
+                    changed.append(key)
+            for key in [key for key in self._locals if key not in updated_locals]:
+                self._remove_local(key)
+                changed.append(key)
+        return changed
+
+    def reset_values(self, paths: Iterable[str]) -> List[str]:
+        """Resets the values to their defaults (removes local values) and returns the paths of the changed ones."""
+        changed = []
+        for path in paths:
+            ref, key = self._prototype.references.resolve(path)
+            slot = self.get_slot_by_key(key)
+            if slot is not None:
+                if self._reset_slot(slot, key):
+                    changed.append(path)
+            elif path in self._locals:
+                self._remove_local(path)
+                changed.append(path)
+        return changed
+
+    def _reset_slot(self, slot: int, key: str) -> bool:
+        default = self._prototype.defaults[slot]
+        current = self.get_slot_value(slot)
+        if current is default:
+            return False
+        self.set_slot_value(slot, default)
+        ref = self._prototype.references.parse(key)
+        self.notify(WMChange(ref=ref, path=ref, old=current, new=default))
+        return True
+
+    def _remove_local(self, key: str):
+        old = self.locals.pop(key)
+        self.notify(WMChange(ref=self._prototype.references.parse(key), path=key, old=old, new=None))
+
     @property
     def all_values_dict(self) -> Dict[str, KBValueDict]:
         res = {}
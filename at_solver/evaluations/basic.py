@@ -1,8 +1,8 @@
 from dataclasses import dataclass
-from typing import List
+from dataclasses import field
+from typing import Set
 from typing import TYPE_CHECKING
 
-from at_krl.core.kb_reference import KBReference
 from at_krl.core.kb_value import Evaluatable
 from at_krl.core.kb_value import KBValue
 from at_krl.core.non_factor import NonFactor
@@ -11,40 +11,67 @@ from at_krl.core.simple.simple_reference import SimpleReference
 from at_krl.core.simple.simple_value import SimpleValue
 from at_krl.core.temporal.allen_evaluatable import AllenEvaluatable
 
+from at_solver.core.references import reference_key
+from at_solver.evaluations.non_factor import get_non_factor
+from at_solver.evaluations.non_factor import NonFactorCalculus
+
 if TYPE_CHECKING:
     from at_solver.core.wm import WorkingMemory
 
 
+# Evaluation results share one default non-factor and boolean and unknown results are interned, so evaluating
+# conditions does not allocate. Results must not be mutated; ``materialize`` makes an own copy of a result
+# before it is stored in the working memory. Operations return results with the shared non-factor; with
+# a ``NonFactorCalculus`` the evaluators propagate non-factors of the operands to the results.
+SHARED_NON_FACTOR = NonFactor()
+TRUE = KBValue(content=True, non_factor=SHARED_NON_FACTOR)
+FALSE = KBValue(content=False, non_factor=SHARED_NON_FACTOR)
+UNKNOWN = KBValue(content=None, non_factor=SHARED_NON_FACTOR)
+
+
+def result_value(content) -> KBValue:
+    if content is True:
+        return TRUE
+    if content is False:
+        return FALSE
+    if content is None:
+        return UNKNOWN
+    return KBValue(content=content, non_factor=SHARED_NON_FACTOR)
+
+
+def materialize(v: KBValue) -> KBValue:
+    nf = v.non_factor
+    if nf is SHARED_NON_FACTOR:
+        return KBValue(
+            content=v.content, non_factor=NonFactor(belief=nf.belief, probability=nf.probability, accuracy=nf.accuracy)
+        )
+    return v
+
+
 @dataclass
 class BasicEvaluator:
     wm: "WorkingMemory"
+    non_factors: NonFactorCalculus = None
+    _linked: Set[str] = field(default_factory=set, init=False, repr=False)
 
-    def eval(self, v: Evaluatable, ref_stack: List[KBReference] = None) -> KBValue:
-        ref_stack = ref_stack or []
+    def eval(self, v: Evaluatable) -> KBValue:
         if v is None:
-            return KBValue(content=None)
+            return UNKNOWN
         elif isinstance(v, KBValue):
             return v
         elif isinstance(v, SimpleValue):
             return KBValue.from_simple(v)
         elif isinstance(v, SimpleReference):
-            if self.wm.ref_is_accessible(v):
-                instance = self.wm.get_instance_by_ref(v)
-                if [r.to_simple().krl for r in ref_stack].count(v.to_simple().krl) > 1:
-                    raise ValueError(
-                        f"""Reference {v.to_simple().krl} has recursive link in wm to evaluate.
-
-                        Reference value is getting form:
-                        {instance.krl}
-                        """
-                    )
-                ref_stack.append(v)
-                return self.eval(instance.value, ref_stack=ref_stack)
+            slot = self.wm.get_slot(v)
+            if slot is not None:
+                value = self.wm.get_slot_value(slot)
             else:
-                local = self.wm.locals.get(v.to_simple().krl)
-                return self.eval(local)
+                value = self.wm.get_local(self.wm.reference_krl(v))
+            if value is None or isinstance(value, (KBValue, SimpleValue)):
+                return self.eval(value)
+            return self.eval_linked(reference_key(v), value)
         elif isinstance(v, AllenEvaluatable):  # Пытаемся достать то, что посчитал темпоральный решатель
-            res = self.wm.locals.get(f"signifier.{v.xml_owner_path}")
+            res = self.wm.get_local(f"signifier.{v.xml_owner_path}")
             if isinstance(res, KBValue):
                 return res
             elif isinstance(res, SimpleValue):
@@ -53,17 +80,97 @@ class BasicEvaluator:
 
         elif isinstance(v, SimpleOperation):
             left_v = self.eval(v.left)
+            if v.operation_name in DECISIVE_OPERANDS:
+                if self.non_factors is not None:
+                    return eval_logical(self.non_factors, v.operation_name, left_v, self.eval(v.right))
+                if is_decisive(v.operation_name, left_v):
+                    return eval_decided(left_v)
+                right_v = self.eval(v.right)
+                if is_decisive(v.operation_name, right_v):
+                    return eval_decided(right_v)
+                if left_v.content is None or right_v.content is None:
+                    return UNKNOWN
+                return self.eval_operation(v.operation_name, left_v, right_v)
             if left_v.content is None:
-                return KBValue(content=None)
+                return UNKNOWN
             if v.is_binary:
                 right_v = self.eval(v.right)
                 if right_v.content is None:
-                    return KBValue(content=None)
-                return EVALUATORS[v.operation_name](left_v, right_v)
-            return EVALUATORS[v.operation_name](left_v)
+                    return UNKNOWN
+                return self.eval_operation(v.operation_name, left_v, right_v)
+            return self.eval_operation(v.operation_name, left_v)
+
+    def eval_linked(self, key: str, value: Evaluatable) -> KBValue:
+        """Evaluates the expression value of a reference, raises ValueError if the expression reads the reference.
+
+        Slots are checked when expressions are written, but locals are not, so the links are also followed with
+        a set of the references being evaluated, which is only filled for expression values.
+        """
+        if key in self._linked:
+            raise ValueError(f"Reference {key} has recursive link in wm to evaluate")
+        self._linked.add(key)
+        try:
+            return self.eval(value)
+        finally:
+            self._linked.discard(key)
+
+    def eval_operation(self, operation_name: str, left_v: KBValue, right_v: KBValue = None) -> KBValue:
+        if right_v is None:
+            result = EVALUATORS[operation_name](left_v)
+            if self.non_factors is None:
+                return result
+            non_factor = self.non_factors.propagate(operation_name, get_non_factor(left_v))
+        else:
+            result = EVALUATORS[operation_name](left_v, right_v)
+            if self.non_factors is None:
+                return result
+            non_factor = self.non_factors.propagate(operation_name, get_non_factor(left_v), get_non_factor(right_v))
+        return KBValue(content=result.content, non_factor=non_factor)
+
+
+# truth value of an operand that decides the result of the logical operation regardless of the other operand,
+# so "false and unknown" is false and "true or unknown" is true (Kleene logic)
+DECISIVE_OPERANDS = {
+    "and": False,
+    "or": True,
+}
+
+
+def is_decisive(operation_name: str, v: SimpleValue) -> bool:
+    return v.content is not None and bool(v.content) is DECISIVE_OPERANDS[operation_name]
+
+
+def eval_decided(v: SimpleValue) -> KBValue:
+    return result_value(v.content)
+
+
+def eval_logical(non_factors: NonFactorCalculus, operation_name: str, left_v: KBValue, right_v: KBValue) -> KBValue:
+    """``and``/``or`` with non-factors of both operands.
+
+    The result is the same as in Kleene logic. A non-factor is the confidence in a value, so the result gets the
+    non-factor of the operand that decides it alone, or the non-factors of both operands combined by
+    ``NonFactorCalculus.logical`` when both operands have the same truth value.
+    """
+    left_decisive = is_decisive(operation_name, left_v)
+    right_decisive = is_decisive(operation_name, right_v)
+    if left_v.content is None or right_v.content is None or left_decisive is not right_decisive:
+        if left_decisive:
+            return KBValue(content=left_v.content, non_factor=get_non_factor(left_v))
+        if right_decisive:
+            return KBValue(content=right_v.content, non_factor=get_non_factor(right_v))
+        return UNKNOWN
+    content = EVALUATORS[operation_name](left_v, right_v).content
+    return KBValue(
+        content=content,
+        non_factor=non_factors.logical(operation_name, content, get_non_factor(left_v), get_non_factor(right_v)),
+    )
 
 
 def unify_number(n):
+    if type(n) is int:
+        return n
+    if type(n) is float:
+        return int(n) if n.is_integer() else n
     f = float(n)
     i = int(f)
     return i if i == f else f
@@ -71,104 +178,87 @@ def unify_number(n):
 
 def eval_eq(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content == right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_gt(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content > right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_ge(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content >= right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_lt(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content < right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_le(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content <= right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_ne(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content != right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_and(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content and right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_or(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content or right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_not(v: SimpleValue, *args, **kwargs) -> KBValue:
     content = not v.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_xor(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = (left.content and not right.content) or (right and not left.content)
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_neg(v: SimpleValue, *args, **kwargs) -> KBValue:
     content = -1 * unify_number(v.content)
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_add(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content + right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_sub(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = left.content - right.content
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_mul(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = unify_number(left.content) * unify_number(right.content)
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_div(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = unify_number(left.content) / unify_number(right.content)
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_mod(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = unify_number(left.content) % unify_number(right.content)
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 def eval_pow(left: SimpleValue, right: SimpleValue) -> KBValue:
     content = unify_number(left.content) ** unify_number(right.content)
-    non_factor = NonFactor()  # TODO: calculate non_factor
-    return KBValue(content=content, non_factor=non_factor)
+    return result_value(content)
 
 
 EVALUATORS = {
@@ -0,0 +1,296 @@
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
+
+from at_krl.core.kb_instruction import AssignInstruction
+from at_krl.core.kb_rule import KBRule
+from at_krl.core.kb_value import Evaluatable
+from at_krl.core.kb_value import KBValue
+from at_krl.core.simple.simple_operation import SimpleOperation
+from at_krl.core.simple.simple_reference import SimpleReference
+from at_krl.core.simple.simple_value import SimpleValue
+from at_krl.core.temporal.allen_evaluatable import AllenEvaluatable
+
+from at_solver.core.references import get_reference_keys
+from at_solver.core.references import reference_key
+from at_solver.evaluations.basic import BasicEvaluator
+from at_solver.evaluations.basic import DECISIVE_OPERANDS
+from at_solver.evaluations.basic import eval_decided
+from at_solver.evaluations.basic import eval_logical
+from at_solver.evaluations.basic import EVALUATORS
+from at_solver.evaluations.basic import UNKNOWN
+from at_solver.evaluations.non_factor import get_non_factor
+from at_solver.evaluations.non_factor import NonFactorCalculus
+
+if TYPE_CHECKING:
+    from at_solver.core.wm import WorkingMemory
+
+
+CompiledEvaluatable = Callable[["WorkingMemory"], KBValue]
+
+
+def compile_evaluatable(
+    v: Evaluatable, compile_operand: Callable = None, non_factors: NonFactorCalculus = None
+) -> CompiledEvaluatable:
+    """Turns an evaluatable into a closure that gives the same result as ``BasicEvaluator(wm).eval(v)``.
+
+    Operation handlers and reference keys are resolved once at compile time, so the closure does not walk
+    the ``SimpleOperation`` tree with isinstance dispatch on every call. Operands of operations are compiled
+    with ``compile_operand``, which is ``compile_evaluatable`` itself by default. With ``non_factors`` operations
+    also propagate non-factors of their operands.
+    """
+    if v is None:
+
+        def compiled_none(wm: "WorkingMemory") -> KBValue:
+            return UNKNOWN
+
+        return compiled_none
+    elif isinstance(v, KBValue):
+
+        def compiled_value(wm: "WorkingMemory") -> KBValue:
+            return v
+
+        return compiled_value
+    elif isinstance(v, SimpleValue):
+        value = KBValue.from_simple(v)
+
+        def compiled_simple_value(wm: "WorkingMemory") -> KBValue:
+            return value
+
+        return compiled_simple_value
+    elif isinstance(v, SimpleReference):
+        return compile_reference(v, non_factors)
+    elif isinstance(v, AllenEvaluatable):
+        key = f"signifier.{v.xml_owner_path}"
+
+        def compiled_allen(wm: "WorkingMemory") -> KBValue:
+            res = wm.get_local(key)
+            if isinstance(res, KBValue):
+                return res
+            elif isinstance(res, SimpleValue):
+                return KBValue.from_simple(res)
+            return KBValue(content=res)
+
+        return compiled_allen
+    elif isinstance(v, SimpleOperation) and v.operation_name in EVALUATORS:
+        return compile_operation(v, compile_operand, non_factors)
+
+    def compiled_fallback(wm: "WorkingMemory") -> KBValue:
+        return BasicEvaluator(wm, non_factors=non_factors).eval(v)
+
+    return compiled_fallback
+
+
+def compile_reference(v: SimpleReference, non_factors: NonFactorCalculus = None) -> CompiledEvaluatable:
+    krl = v.to_simple().krl
+    key = reference_key(v)
+
+    def compiled_reference(wm: "WorkingMemory") -> KBValue:
+        slot = wm.get_slot_by_key(key)
+        value = wm.get_slot_value(slot) if slot is not None else wm.get_local(krl)
+        if isinstance(value, KBValue):
+            return value
+        return BasicEvaluator(wm, non_factors=non_factors).eval_linked(key, value)
+
+    return compiled_reference
+
+
+def compile_operation(
+    v: SimpleOperation, compile_operand: Callable = None, non_factors: NonFactorCalculus = None
+) -> CompiledEvaluatable:
+    if non_factors is not None:
+        return compile_propagating_operation(v, compile_operand, non_factors)
+    compile_operand = compile_operand or compile_evaluatable
+    operation = EVALUATORS[v.operation_name]
+    left = compile_operand(v.left)
+
+    if not v.is_binary:
+
+        def compiled_unary(wm: "WorkingMemory") -> KBValue:
+            left_v = left(wm)
+            if left_v.content is None:
+                return UNKNOWN
+            return operation(left_v)
+
+        return compiled_unary
+
+    right = compile_operand(v.right)
+
+    if v.operation_name in DECISIVE_OPERANDS:
+        decisive = DECISIVE_OPERANDS[v.operation_name]
+
+        def compiled_logical(wm: "WorkingMemory") -> KBValue:
+            left_v = left(wm)
+            if left_v.content is not None and bool(left_v.content) is decisive:
+                return eval_decided(left_v)
+            right_v = right(wm)
+            if right_v.content is not None and bool(right_v.content) is decisive:
+                return eval_decided(right_v)
+            if left_v.content is None or right_v.content is None:
+                return UNKNOWN
+            return operation(left_v, right_v)
+
+        return compiled_logical
+
+    def compiled_binary(wm: "WorkingMemory") -> KBValue:
+        left_v = left(wm)
+        if left_v.content is None:
+            return UNKNOWN
+        right_v = right(wm)
+        if right_v.content is None:
+            return UNKNOWN
+        return operation(left_v, right_v)
+
+    return compiled_binary
+
+
+def compile_propagating_operation(
+    v: SimpleOperation, compile_operand: Callable = None, non_factors: NonFactorCalculus = None
+) -> CompiledEvaluatable:
+    """Same as ``compile_operation``, but the result gets the non-factor propagated from the operands.
+
+    ``and`` and ``or`` evaluate both operands, since the non-factor of the result can depend on both of them.
+    """
+    compile_operand = compile_operand or (lambda operand: compile_evaluatable(operand, non_factors=non_factors))
+    operation = EVALUATORS[v.operation_name]
+    propagate = non_factors.get_propagation(v.operation_name)
+    left = compile_operand(v.left)
+
+    if not v.is_binary:
+
+        def compiled_unary(wm: "WorkingMemory") -> KBValue:
+            left_v = left(wm)
+            if left_v.content is None:
+                return UNKNOWN
+            return KBValue(content=operation(left_v).content, non_factor=propagate(get_non_factor(left_v)))
+
+        return compiled_unary
+
+    right = compile_operand(v.right)
+
+    if v.operation_name in DECISIVE_OPERANDS:
+        operation_name = v.operation_name
+
+        def compiled_logical(wm: "WorkingMemory") -> KBValue:
+            return eval_logical(non_factors, operation_name, left(wm), right(wm))
+
+        return compiled_logical
+
+    def compiled_binary(wm: "WorkingMemory") -> KBValue:
+        left_v = left(wm)
+        if left_v.content is None:
+            return UNKNOWN
+        right_v = right(wm)
+        if right_v.content is None:
+            return UNKNOWN
+        return KBValue(
+            content=operation(left_v, right_v).content,
+            non_factor=propagate(get_non_factor(left_v), get_non_factor(right_v)),
+        )
+
+    return compiled_binary
+
+
+def structural_key(v: Evaluatable, with_non_factors: bool = False) -> Union[Tuple, None]:
+    """Key that is equal for equal pure expressions, None when the expression is not pure or not supported."""
+    if v is None:
+        return ("none",)
+    elif isinstance(v, KBValue) or isinstance(v, SimpleValue):
+        content = v.content
+        if with_non_factors:
+            nf = get_non_factor(v)
+            return ("value", type(content), content, nf.belief, nf.probability, nf.accuracy)
+        return ("value", type(content), content)
+    elif isinstance(v, SimpleReference):
+        return ("ref", reference_key(v))
+    elif isinstance(v, SimpleOperation) and v.operation_name in EVALUATORS:
+        left = structural_key(v.left, with_non_factors)
+        if left is None:
+            return None
+        if not v.is_binary:
+            return (v.operation_name, left)
+        right = structural_key(v.right, with_non_factors)
+        if right is None:
+            return None
+        return (v.operation_name, left, right)
+    return None
+
+
+class ExpressionCompiler:
+    """Cache of compiled rule conditions and assigned values.
+
+    Compiled closures are keyed by identity of the evaluatable, which lives as long as the knowledge base.
+    Pure operations (without temporal operands) are also shared between equal expressions and memoized:
+    the last result of an operation is kept with the versions of the working memory slots it reads
+    and is returned again while the versions are the same. With ``non_factors`` the compiled expressions
+    propagate non-factors, which is off by default.
+    """
+
+    non_factors: NonFactorCalculus
+    _compiled: Dict[int, Tuple[Evaluatable, CompiledEvaluatable]]
+    _shared: Dict[Hashable, CompiledEvaluatable]
+    _memos: List[List]
+
+    def __init__(self, non_factors: NonFactorCalculus = None) -> None:
+        self.non_factors = non_factors
+        self._compiled = {}
+        self._shared = {}
+        self._memos = []
+
+    def compile(self, v: Evaluatable) -> CompiledEvaluatable:
+        compiled = self._compiled.get(id(v))
+        if compiled is None or compiled[0] is not v:
+            compiled = (v, self._compile(v))
+            self._compiled[id(v)] = compiled
+        return compiled[1]
+
+    def _compile(self, v: Evaluatable) -> CompiledEvaluatable:
+        if not isinstance(v, SimpleOperation) or v.operation_name not in EVALUATORS:
+            return compile_evaluatable(v, self.compile, self.non_factors)
+        key = structural_key(v, with_non_factors=self.non_factors is not None)
+        if key is None:
+            return self.compile_operation(v)
+        shared = self._shared.get(key)
+        if shared is None:
+            shared = self.memoize(self.compile_operation(v), get_reference_keys(v))
+            self._shared[key] = shared
+        return shared
+
+    def compile_operation(self, v: SimpleOperation) -> CompiledEvaluatable:
+        """Compiles one operation, its operands are compiled through the cache."""
+        return compile_operation(v, self.compile, self.non_factors)
+
+    def memoize(self, compiled: CompiledEvaluatable, keys: List[str]) -> CompiledEvaluatable:
+        memo = [None, None]
+        self._memos.append(memo)
+
+        def memoized(wm: "WorkingMemory") -> KBValue:
+            versions = wm.get_versions(keys)
+            if versions is None:
+                return compiled(wm)
+            if memo[0] == versions:
+                return memo[1]
+            value = compiled(wm)
+            memo[0] = versions
+            memo[1] = value
+            return value
+
+        return memoized
+
+    def clear_cache(self) -> None:
+        for memo in self._memos:
+            memo[0] = memo[1] = None
+
+    def compile_rules(self, rules: List[KBRule]) -> None:
+        for rule in rules:
+            self.compile(rule.condition)
+            for instruction in rule.instructions + (rule.else_instructions or []):
+                if isinstance(instruction, AssignInstruction):
+                    self.compile(instruction.value)
+
+    def eval(self, v: Evaluatable, wm: "WorkingMemory") -> KBValue:
+        return self.compile(v)(wm)
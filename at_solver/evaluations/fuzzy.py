@@ -0,0 +1,394 @@
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
+
+from at_krl.core.kb_type import KBType
+from at_krl.core.kb_value import Evaluatable
+from at_krl.core.kb_value import KBValue
+from at_krl.core.simple.simple_operation import SimpleOperation
+from at_krl.core.simple.simple_reference import SimpleReference
+
+from at_solver.core.references import reference_key
+from at_solver.evaluations.basic import BasicEvaluator
+from at_solver.evaluations.basic import result_value
+from at_solver.evaluations.basic import UNKNOWN
+from at_solver.evaluations.compiled import CompiledEvaluatable
+from at_solver.evaluations.compiled import ExpressionCompiler
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+if TYPE_CHECKING:
+    from at_solver.core.wm import WorkingMemory
+
+
+class MEMBERSHIP_FUNCTION:
+    triangular = "triangular"
+    trapezoidal = "trapezoidal"
+    gaussian = "gaussian"
+    piecewise_linear = "piecewise_linear"
+
+    @classmethod
+    def all(cls) -> List[str]:
+        return [cls.triangular, cls.trapezoidal, cls.gaussian, cls.piecewise_linear]
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('Fuzzy evaluation requires NumPy, install it with "pip install at-solver[fuzzy]"')
+
+
+def trapezoidal(x, a, b, c, d):
+    """Trapezoid membership, all arguments are broadcast. Vertical edges (a == b or c == d) are allowed."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rising = np.where(b > a, (x - a) / np.where(b > a, b - a, 1), np.where(x >= a, 1.0, 0.0))
+        falling = np.where(d > c, (d - x) / np.where(d > c, d - c, 1), np.where(x <= d, 1.0, 0.0))
+    return np.clip(np.minimum(rising, falling), 0.0, 1.0)
+
+
+def triangular(x, a, b, c):
+    return trapezoidal(x, a, b, b, c)
+
+
+def gaussian(x, mean, sigma):
+    return np.exp(-0.5 * ((x - mean) / sigma) ** 2)
+
+
+def piecewise_linear(x, xs, ys):
+    return np.interp(x, xs, ys, left=ys[0], right=ys[-1])
+
+
+@dataclass
+class MembershipFunction:
+    name: str
+    kind: str
+    params: Tuple
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.kind == MEMBERSHIP_FUNCTION.triangular:
+            return triangular(x, *self.params)
+        elif self.kind == MEMBERSHIP_FUNCTION.trapezoidal:
+            return trapezoidal(x, *self.params)
+        elif self.kind == MEMBERSHIP_FUNCTION.gaussian:
+            return gaussian(x, *self.params)
+        return piecewise_linear(x, *self.params)
+
+    @property
+    def bounds(self) -> Tuple[float, float]:
+        if self.kind == MEMBERSHIP_FUNCTION.gaussian:
+            mean, sigma = self.params
+            return mean - 4 * sigma, mean + 4 * sigma
+        elif self.kind == MEMBERSHIP_FUNCTION.piecewise_linear:
+            return float(self.params[0][0]), float(self.params[0][-1])
+        return float(self.params[0]), float(self.params[-1])
+
+
+def _get(item: Any, name: str, default: Any = None) -> Any:
+    if isinstance(item, dict):
+        return item.get(name, default)
+    return getattr(item, name, default)
+
+
+def _read_point(point: Any) -> Tuple[float, float]:
+    if isinstance(point, (list, tuple)):
+        return float(point[0]), float(point[1])
+    return float(_get(point, "x")), float(_get(point, "y"))
+
+
+def read_membership_function(mf: Any) -> Union[MembershipFunction, None]:
+    """Reads a membership function of a KB fuzzy type.
+
+    Functions given by points are recognized as triangular or trapezoidal by their shape, otherwise they are
+    piecewise linear. A function can also declare its ``kind`` and ``params`` explicitly (for gaussian ones).
+    """
+    name = _get(mf, "name") or _get(mf, "id")
+    if name is None:
+        return None
+    kind = _get(mf, "kind")
+    if kind in MEMBERSHIP_FUNCTION.all() and _get(mf, "params") is not None:
+        params = tuple(float(p) for p in _get(mf, "params"))
+        return MembershipFunction(name=name, kind=kind, params=params)
+
+    points = sorted(_read_point(point) for point in _get(mf, "points", None) or [])
+    if not points:
+        return None
+    xs = tuple(x for x, _ in points)
+    ys = tuple(y for _, y in points)
+    if len(points) == 3 and ys == (0, 1, 0):
+        return MembershipFunction(name=name, kind=MEMBERSHIP_FUNCTION.triangular, params=xs)
+    if len(points) == 4 and ys == (0, 1, 1, 0):
+        return MembershipFunction(name=name, kind=MEMBERSHIP_FUNCTION.trapezoidal, params=xs)
+    return MembershipFunction(name=name, kind=MEMBERSHIP_FUNCTION.piecewise_linear, params=(xs, ys))
+
+
+class FuzzyVariable:
+    """Fuzzy property of the working memory with its terms sampled on the universe for defuzzification."""
+
+    key: str
+    terms: List[MembershipFunction]
+    term_index: Dict[str, int]
+    universe: "np.ndarray"
+    memberships: "np.ndarray"
+
+    def __init__(
+        self,
+        key: str,
+        terms: List[MembershipFunction],
+        lower: float = None,
+        upper: float = None,
+        resolution: int = 201,
+    ) -> None:
+        self.key = key
+        self.terms = terms
+        bounds = [mf.bounds for mf in terms]
+        lower = min(b[0] for b in bounds) if lower is None else lower
+        upper = max(b[1] for b in bounds) if upper is None else upper
+        self.universe = np.linspace(lower, upper, resolution)
+        self.memberships = np.stack([mf(self.universe) for mf in terms])
+        self.term_index = {mf.name: i for i, mf in enumerate(terms)}
+
+    @classmethod
+    def from_type(cls, key: str, kb_type: KBType) -> Union["FuzzyVariable", None]:
+        """Variable of a property of a fuzzy type.
+
+        The universe spans the ``min`` and ``max`` of the membership functions of the type, or the bounds
+        of the terms when they are not given.
+        """
+        functions = _get(kb_type, "membership_functions", None) or []
+        terms = [mf for mf in map(read_membership_function, functions) if mf is not None]
+        if not terms:
+            return None
+        lowers = [_get(mf, "min") for mf in functions if _get(mf, "min") is not None]
+        uppers = [_get(mf, "max") for mf in functions if _get(mf, "max") is not None]
+        lower = float(min(lowers)) if lowers else None
+        upper = float(max(uppers)) if uppers else None
+        return cls(key, terms, lower=lower, upper=upper)
+
+    def defuzzify(self, degrees: Dict[str, float]) -> Union[float, None]:
+        """Centroid of the union of the terms clipped by their degrees (Mamdani inference)."""
+        clip = np.zeros(len(self.terms))
+        for term, degree in degrees.items():
+            index = self.term_index.get(term)
+            if index is not None:
+                clip[index] = degree
+        aggregated = np.max(np.minimum(self.memberships, clip[:, None]), axis=0)
+        area = aggregated.sum()
+        if area <= 0:
+            return None
+        return float((self.universe * aggregated).sum() / area)
+
+
+class FuzzyModel:
+    """Fuzzy variables of a knowledge base and vectorized fuzzification of their working memory values.
+
+    Triangular, trapezoidal and gaussian terms of all variables are evaluated with one NumPy expression per
+    kind of function. Fuzzified degrees are kept while the versions of the fuzzy slots stay the same.
+    """
+
+    variables: Dict[str, FuzzyVariable]
+    keys: List[str]
+
+    def __init__(self, variables: Iterable[FuzzyVariable]) -> None:
+        require_numpy()
+        self.variables = {variable.key: variable for variable in variables}
+        self.keys = list(self.variables)
+        rows = {kind: [] for kind in MEMBERSHIP_FUNCTION.all()}
+        for index, variable in enumerate(self.variables.values()):
+            for mf in variable.terms:
+                rows[mf.kind].append((index, mf))
+        self._rows = {}
+        for kind, kind_rows in rows.items():
+            if not kind_rows or kind == MEMBERSHIP_FUNCTION.piecewise_linear:
+                continue
+            indexes = np.array([index for index, _ in kind_rows])
+            params = np.array([mf.params for _, mf in kind_rows], dtype=float).T
+            self._rows[kind] = (indexes, params, [(self.keys[index], mf.name) for index, mf in kind_rows])
+        self._piecewise = [(index, mf) for index, mf in rows[MEMBERSHIP_FUNCTION.piecewise_linear]]
+        self._cache = (None, None)
+
+    @classmethod
+    def from_templates(cls, templates: Iterable[Tuple[str, Any]]) -> "FuzzyModel":
+        variables = []
+        for key, instance in templates:
+            kb_type = getattr(getattr(instance, "type", None), "target", None)
+            if isinstance(kb_type, KBType) and _get(kb_type, "meta") == "fuzzy":
+                variable = FuzzyVariable.from_type(key, kb_type)
+                if variable is not None:
+                    variables.append(variable)
+        return cls(variables)
+
+    def get_numbers(self, wm: "WorkingMemory") -> "np.ndarray":
+        numbers = np.full(len(self.keys), np.nan)
+        for index, key in enumerate(self.keys):
+            value = wm.get_value(key)
+            content = getattr(value, "content", None)
+            if isinstance(content, (int, float)) and not isinstance(content, bool):
+                numbers[index] = content
+        return numbers
+
+    def fuzzify(self, wm: "WorkingMemory") -> Dict[str, Dict[str, float]]:
+        """Membership degrees of numeric values of all fuzzy properties to all their terms."""
+        versions = wm.get_versions(self.keys)
+        if versions is not None and self._cache[0] == versions:
+            return self._cache[1]
+        numbers = self.get_numbers(wm)
+        degrees = {key: {} for key in self.keys}
+        functions = {
+            MEMBERSHIP_FUNCTION.triangular: triangular,
+            MEMBERSHIP_FUNCTION.trapezoidal: trapezoidal,
+            MEMBERSHIP_FUNCTION.gaussian: gaussian,
+        }
+        for kind, (indexes, params, names) in self._rows.items():
+            x = numbers[indexes]
+            values = functions[kind](x, *params)
+            for (key, term), known, degree in zip(names, ~np.isnan(x), values):
+                if known:
+                    degrees[key][term] = float(degree)
+        for index, mf in self._piecewise:
+            if not np.isnan(numbers[index]):
+                degrees[self.keys[index]][mf.name] = float(mf(numbers[index]))
+        self._cache = (versions, degrees)
+        return degrees
+
+    def get_term_degree(self, wm: "WorkingMemory", key: str, term_name: Any) -> Union[float, None]:
+        """Membership degree of the value of a fuzzy property to its term, None when it is not known."""
+        if key not in self.variables or not isinstance(term_name, str):
+            return None
+        return self.fuzzify(wm).get(key, {}).get(term_name)
+
+    def clear_cache(self):
+        self._cache = (None, None)
+
+
+@dataclass
+class FuzzyEvaluator(BasicEvaluator):
+    """Evaluator with truth degrees in [0, 1] instead of boolean values.
+
+    ``ref = "term"`` for a fuzzy property is the membership degree of its value to the term, ``and``, ``or`` and
+    ``not`` are ``min``, ``max`` and ``1 - x``. Other operations are evaluated as by ``BasicEvaluator`` and
+    boolean results take degrees 1 and 0.
+    """
+
+    model: FuzzyModel = None
+
+    def eval(self, v: Evaluatable) -> KBValue:
+        if isinstance(v, SimpleOperation):
+            if v.operation_name in ("eq", "ne"):
+                degree = self.get_term_degree(v.left, v.right)
+                if degree is None:
+                    degree = self.get_term_degree(v.right, v.left)
+                if degree is not None:
+                    return result_value(degree if v.operation_name == "eq" else 1.0 - degree)
+            elif v.operation_name in ("and", "or"):
+                left = self.get_degree(self.eval(v.left))
+                right = self.get_degree(self.eval(v.right))
+                if v.operation_name == "and":
+                    return self.fuzzy_and(left, right)
+                return self.fuzzy_or(left, right)
+            elif v.operation_name == "not":
+                degree = self.get_degree(self.eval(v.left))
+                return UNKNOWN if degree is None else result_value(1.0 - degree)
+        return super().eval(v)
+
+    def get_term_degree(self, ref: Evaluatable, term: Evaluatable) -> Union[float, None]:
+        if not isinstance(ref, SimpleReference) or self.model is None:
+            return None
+        key = reference_key(ref)
+        if key not in self.model.variables:
+            return None
+        return self.model.get_term_degree(self.wm, key, getattr(super().eval(term), "content", None))
+
+    @staticmethod
+    def get_degree(v: KBValue) -> Union[float, None]:
+        if v.content is None:
+            return None
+        if isinstance(v.content, bool):
+            return 1.0 if v.content else 0.0
+        if isinstance(v.content, (int, float)):
+            return min(1.0, max(0.0, float(v.content)))
+        return 1.0 if v.content else 0.0
+
+    @staticmethod
+    def fuzzy_and(left: Union[float, None], right: Union[float, None]) -> KBValue:
+        if left == 0.0 or right == 0.0:
+            return result_value(0.0)
+        if left is None or right is None:
+            return UNKNOWN
+        return result_value(min(left, right))
+
+    @staticmethod
+    def fuzzy_or(left: Union[float, None], right: Union[float, None]) -> KBValue:
+        if left == 1.0 or right == 1.0:
+            return result_value(1.0)
+        if left is None or right is None:
+            return UNKNOWN
+        return result_value(max(left, right))
+
+
+class FuzzyExpressions(ExpressionCompiler):
+    """``ExpressionCompiler`` with the semantics of ``FuzzyEvaluator``.
+
+    Term comparisons and fuzzy ``and``, ``or`` and ``not`` are compiled into closures, which are shared and
+    memoized as other operations. Other operations are compiled as by ``ExpressionCompiler``.
+    """
+
+    model: FuzzyModel
+
+    def __init__(self, model: FuzzyModel) -> None:
+        super().__init__()
+        self.model = model
+
+    def clear_cache(self) -> None:
+        super().clear_cache()
+        self.model.clear_cache()
+
+    def compile_operation(self, v: SimpleOperation) -> CompiledEvaluatable:
+        if v.operation_name in ("eq", "ne"):
+            return self.compile_term_comparison(v)
+        elif v.operation_name in ("and", "or"):
+            left = self.compile(v.left)
+            right = self.compile(v.right)
+            combine = FuzzyEvaluator.fuzzy_and if v.operation_name == "and" else FuzzyEvaluator.fuzzy_or
+
+            def compiled_fuzzy_logical(wm: "WorkingMemory") -> KBValue:
+                return combine(FuzzyEvaluator.get_degree(left(wm)), FuzzyEvaluator.get_degree(right(wm)))
+
+            return compiled_fuzzy_logical
+        elif v.operation_name == "not":
+            left = self.compile(v.left)
+
+            def compiled_fuzzy_not(wm: "WorkingMemory") -> KBValue:
+                degree = FuzzyEvaluator.get_degree(left(wm))
+                return UNKNOWN if degree is None else result_value(1.0 - degree)
+
+            return compiled_fuzzy_not
+        return super().compile_operation(v)
+
+    def compile_term_comparison(self, v: SimpleOperation) -> CompiledEvaluatable:
+        """Membership degree when one operand is a fuzzy property, otherwise the crisp comparison."""
+        crisp = super().compile_operation(v)
+        terms = [
+            (reference_key(ref), self.compile(term))
+            for ref, term in ((v.left, v.right), (v.right, v.left))
+            if isinstance(ref, SimpleReference) and reference_key(ref) in self.model.variables
+        ]
+        if not terms:
+            return crisp
+        negate = v.operation_name == "ne"
+
+        def compiled_term_comparison(wm: "WorkingMemory") -> KBValue:
+            for key, term in terms:
+                degree = self.model.get_term_degree(wm, key, term(wm).content)
+                if degree is not None:
+                    return result_value(1.0 - degree if negate else degree)
+            return crisp(wm)
+
+        return compiled_term_comparison
@@ -0,0 +1,156 @@
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Union
+
+from at_krl.core.non_factor import NonFactor
+
+
+Number = Union[int, float]
+# belief and probability are the lower and the upper bounds of the certainty interval, in percents
+MAX_CERTAINTY = 100
+
+
+class NON_FACTOR_LOGIC:
+    min = "min"
+    product = "product"
+    lukasiewicz = "lukasiewicz"
+
+    @classmethod
+    def all(cls) -> List[str]:
+        return [cls.min, cls.product, cls.lukasiewicz]
+
+
+class NON_FACTOR_COMBINE:
+    replace = "replace"
+    max = "max"
+    noisy_or = "noisy_or"
+
+    @classmethod
+    def all(cls) -> List[str]:
+        return [cls.replace, cls.max, cls.noisy_or]
+
+
+DEFAULT_NON_FACTOR = NonFactor()
+
+
+def get_non_factor(v) -> NonFactor:
+    return v.non_factor or DEFAULT_NON_FACTOR
+
+
+T_NORMS: Dict[str, Callable[[Number, Number], Number]] = {
+    NON_FACTOR_LOGIC.min: min,
+    NON_FACTOR_LOGIC.product: lambda a, b: a * b / MAX_CERTAINTY,
+    NON_FACTOR_LOGIC.lukasiewicz: lambda a, b: max(0, a + b - MAX_CERTAINTY),
+}
+
+T_CONORMS: Dict[str, Callable[[Number, Number], Number]] = {
+    NON_FACTOR_LOGIC.min: max,
+    NON_FACTOR_LOGIC.product: lambda a, b: a + b - a * b / MAX_CERTAINTY,
+    NON_FACTOR_LOGIC.lukasiewicz: lambda a, b: min(MAX_CERTAINTY, a + b),
+}
+
+# operations whose accuracy is the sum of accuracies of operands, other operations keep the worst one
+ADDITIVE_ACCURACY = {"add", "sub", "neg"}
+
+
+class NonFactorCalculus:
+    """Propagation of non-factors through evaluated operations.
+
+    A non-factor is the confidence in a value: belief and probability are the bounds of the certainty interval.
+    Comparisons and arithmetic combine the bounds of operands with the t-norm of ``logic``. ``and`` and ``or``
+    use the t-norm when their result holds only if both operands hold (true ``and``, false ``or``) and the dual
+    t-conorm otherwise. ``not`` keeps the confidence of its operand, as does the else branch of a rule.
+    ``combine`` is the policy for a value that is assigned again by another rule.
+
+    The propagation function of every operation is chosen once by ``get_propagation``, so compiled expressions
+    call it directly without dispatch.
+    """
+
+    logic: str
+    combine_policy: str
+
+    def __init__(self, logic: str = None, combine: str = None) -> None:
+        logic = logic or NON_FACTOR_LOGIC.min
+        combine = combine or NON_FACTOR_COMBINE.replace
+        if logic not in NON_FACTOR_LOGIC.all():
+            raise ValueError(f'Invalid non-factor logic "{logic}"')
+        if combine not in NON_FACTOR_COMBINE.all():
+            raise ValueError(f'Invalid non-factor combination policy "{combine}"')
+        self.logic = logic
+        self.combine_policy = combine
+        self.t_norm = T_NORMS[logic]
+        self.t_conorm = T_CONORMS[logic]
+
+    def conjunction(self, left: NonFactor, right: NonFactor) -> NonFactor:
+        t_norm = self.t_norm
+        return NonFactor(
+            belief=t_norm(left.belief, right.belief),
+            probability=t_norm(left.probability, right.probability),
+            accuracy=max(left.accuracy, right.accuracy),
+        )
+
+    def disjunction(self, left: NonFactor, right: NonFactor) -> NonFactor:
+        t_conorm = self.t_conorm
+        return NonFactor(
+            belief=t_conorm(left.belief, right.belief),
+            probability=t_conorm(left.probability, right.probability),
+            accuracy=max(left.accuracy, right.accuracy),
+        )
+
+    def identity(self, v: NonFactor) -> NonFactor:
+        return v
+
+    def logical(self, operation_name: str, result: bool, left: NonFactor, right: NonFactor) -> NonFactor:
+        """Non-factor of ``and`` or ``or`` of two operands with the same truth value."""
+        if (operation_name == "and") is bool(result):
+            return self.conjunction(left, right)
+        return self.disjunction(left, right)
+
+    def additive(self, left: NonFactor, right: NonFactor = None) -> NonFactor:
+        if right is None:
+            return left
+        return NonFactor(
+            belief=self.t_norm(left.belief, right.belief),
+            probability=self.t_norm(left.probability, right.probability),
+            accuracy=left.accuracy + right.accuracy,
+        )
+
+    def get_propagation(self, operation_name: str) -> Callable[..., NonFactor]:
+        """Propagation function of the operation, except ``and`` and ``or``, which depend on the result."""
+        if operation_name == "not":
+            return self.identity
+        elif operation_name in ADDITIVE_ACCURACY:
+            return self.additive
+        return self.conjunction
+
+    def propagate(self, operation_name: str, left: NonFactor, right: NonFactor = None) -> NonFactor:
+        if right is None:
+            return self.get_propagation(operation_name)(left)
+        return self.get_propagation(operation_name)(left, right)
+
+    def conclude(self, value: NonFactor, condition: NonFactor, instruction: NonFactor = None) -> NonFactor:
+        """Non-factor of a value assigned by a rule with the evaluated condition."""
+        result = self.conjunction(condition, value)
+        result.accuracy = value.accuracy
+        if instruction is not None:
+            accuracy = result.accuracy
+            result = self.conjunction(result, instruction)
+            result.accuracy = accuracy
+        return result
+
+    def combine(self, old: NonFactor, new: NonFactor) -> NonFactor:
+        """Non-factor of the same value assigned again."""
+        if self.combine_policy == NON_FACTOR_COMBINE.max:
+            return NonFactor(
+                belief=max(old.belief, new.belief),
+                probability=max(old.probability, new.probability),
+                accuracy=min(old.accuracy, new.accuracy),
+            )
+        elif self.combine_policy == NON_FACTOR_COMBINE.noisy_or:
+            return NonFactor(
+                belief=T_CONORMS[NON_FACTOR_LOGIC.product](old.belief, new.belief),
+                probability=T_CONORMS[NON_FACTOR_LOGIC.product](old.probability, new.probability),
+                accuracy=min(old.accuracy, new.accuracy),
+            )
+        return new
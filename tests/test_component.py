@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("at_queue")
+
+from at_queue.core.session import ConnectionParameters  # noqa: E402
+
+from at_solver.core.component import ATSolver  # noqa: E402
+from tests.test_solver import build_solver  # noqa: E402
+
+
+@pytest.fixture
+def component():
+    component = ATSolver(connection_parameters=ConnectionParameters(host="localhost"))
+
+    async def get_user_id_or_token(auth_token, raize_on_failed=False):
+        return auth_token or "default"
+
+    component.get_user_id_or_token = get_user_id_or_token
+    component.solvers["token"] = build_solver()
+    return component
+
+
+def fake_external_methods(component, responses):
+    calls = []
+
+    async def exec_external_method(reciever, methode_name, method_args, auth_token=None):
+        calls.append((reciever, methode_name))
+        response = responses[methode_name]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    component.exec_external_method = exec_external_method
+    return calls
+
+
+def test_incremental_bb_sync_applies_changes_and_removals(component):
+    solver = component.solvers["token"]
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.bb_revision = 1
+    delta = {"revision": 2, "items": [{"ref": "object1.attr1", "value": 5}], "removed": ["object1.attr2"]}
+    fake_external_methods(component, {"get_items_since": delta})
+
+    assert asyncio.run(component.update_wm_from_bb(incremental=True, auth_token="token"))
+    assert solver.wm.get_value("object1.attr1").content == 5
+    value = solver.wm.get_value("object1.attr2")
+    assert value is None or value.content is None
+    assert solver.bb_revision == 2
+
+
+def test_incremental_bb_sync_raises_transient_errors(component):
+    solver = component.solvers["token"]
+    fake_external_methods(component, {"get_items_since": TimeoutError("blackboard did not answer")})
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(component.update_wm_from_bb(incremental=True, auth_token="token"))
+    assert solver.bb_revisions_supported
+
+
+def test_incremental_bb_sync_falls_back_without_revisions(component):
+    solver = component.solvers["token"]
+    other = build_solver()
+    component.solvers["other"] = other
+    calls = fake_external_methods(
+        component,
+        {
+            "get_items_since": Exception('Method "get_items_since" not found'),
+            "get_all_items": [{"ref": "object1.attr1", "value": 3}],
+        },
+    )
+
+    assert asyncio.run(component.update_wm_from_bb(incremental=True, auth_token="token"))
+    assert [method for _, method in calls] == ["get_items_since", "get_all_items"]
+    assert solver.wm.get_value("object1.attr1").content == 3
+    assert not solver.bb_revisions_supported
+    assert other.bb_revisions_supported
+
+
+def fake_external_checks(component, registered=True, configured=True):
+    calls = []
+
+    async def check_external_registered(name):
+        calls.append(("registered", name))
+        return registered
+
+    async def check_external_configured(name, auth_token=None):
+        calls.append(("configured", name))
+        return configured
+
+    component.check_external_registered = check_external_registered
+    component.check_external_configured = check_external_configured
+    return calls
+
+
+def test_external_status_is_cached(component):
+    calls = fake_external_checks(component)
+    fake_external_methods(component, {"request_value": None, "get_item": {"value": 5}})
+    request_value = component.on_request_value("token")
+
+    asyncio.run(request_value("object1.attr1"))
+    asyncio.run(request_value("object1.attr1"))
+    assert calls == [("registered", "ATDialoger"), ("registered", "ATBlackBoard"), ("configured", "ATDialoger")]
+    assert component.solvers["token"].wm.get_value("object1.attr1").content == 5
+
+
+def test_external_status_expires(component):
+    component.external_status_ttl = 0
+    calls = fake_external_checks(component)
+
+    assert asyncio.run(component.check_external_registered_cached("ATDialoger"))
+    assert asyncio.run(component.check_external_registered_cached("ATDialoger"))
+    assert len(calls) == 2
+
+
+def test_negative_external_status_is_not_cached(component):
+    calls = fake_external_checks(component, registered=False)
+
+    assert not asyncio.run(component.check_external_registered_cached("ATDialoger"))
+    assert not asyncio.run(component.check_external_registered_cached("ATDialoger"))
+    assert len(calls) == 2
+
+
+def test_external_status_is_invalidated_when_component_is_not_registered(component):
+    fake_external_checks(component)
+    assert asyncio.run(component.check_external_configured_cached("ATDialoger", auth_token="token"))
+    assert asyncio.run(component.check_external_configured_cached("ATDialoger", auth_token="other"))
+
+    fake_external_checks(component, registered=False)
+    assert not asyncio.run(component.check_external_registered_cached("ATDialoger"))
+    calls = fake_external_checks(component)
+    assert asyncio.run(component.check_external_configured_cached("ATDialoger", auth_token="token"))
+    assert asyncio.run(component.check_external_configured_cached("ATDialoger", auth_token="other"))
+    assert len(calls) == 2
+
+
+def test_external_status_is_invalidated_after_failed_call(component):
+    calls = fake_external_checks(component)
+    fake_external_methods(component, {"request_value": TimeoutError("dialoger did not answer")})
+    request_value = component.on_request_value("token")
+
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            asyncio.run(request_value("object1.attr1"))
+    assert len(calls) == 6
+
+
+def test_external_status_is_invalidated_on_configuration(component):
+    calls = fake_external_checks(component)
+
+    assert asyncio.run(component.check_external_configured_cached("ATDialoger", auth_token="token"))
+    asyncio.run(component.create_solver(component.solvers["token"].kb, auth_token="token"))
+    assert asyncio.run(component.check_external_configured_cached("ATDialoger", auth_token="token"))
+    assert len(calls) == 2
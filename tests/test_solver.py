@@ -1,13 +1,35 @@
+import asyncio
+import sys
+from textwrap import dedent
+from typing import Dict
 from typing import List
 
 import pytest
+from at_krl.core.kb_instruction import AssignInstruction
 from at_krl.core.kb_reference import KBReference
+from at_krl.core.kb_value import KBValue
 from at_krl.core.knowledge_base import KnowledgeBase
+from at_krl.core.non_factor import NonFactor
 
+from at_solver.core.agenda import Agenda
+from at_solver.core.agenda import AGENDA_STRATEGY
+from at_solver.core.dependencies import find_cycles
+from at_solver.core.dependencies import ordered_components
 from at_solver.core.goals import Goal
 from at_solver.core.solver import Solver
+from at_solver.core.solver import SOLVER_EVALUATOR
 from at_solver.core.solver import SOLVER_MODE
+from at_solver.core.trace import CHECKPOINT_INTERVAL
 from at_solver.core.trace import ForwardStep
+from at_solver.core.trace import TRACE_LEVEL
+from at_solver.core.wm import WMUpdate
+from at_solver.core.wm import WorkingMemory
+from at_solver.evaluations.basic import BasicEvaluator
+from at_solver.evaluations.basic import SHARED_NON_FACTOR
+from at_solver.evaluations.basic import unify_number
+from at_solver.evaluations.non_factor import NON_FACTOR_COMBINE
+from at_solver.evaluations.non_factor import NON_FACTOR_LOGIC
+from at_solver.evaluations.non_factor import NonFactorCalculus
 
 
 @pytest.fixture
@@ -15,7 +37,7 @@ def big_kb():
     return KnowledgeBase.from_krl(open("./tests/fixtures/TrafficAccidentsKB.kbs").read())
 
 
-def build_solver(goals: List[Goal] = []):
+def build_solver(goals: List[Goal] = [], **kwargs):
     kb_dict = {
         "tag": "knowledge-base",
         "problem_info": None,
@@ -224,10 +246,27 @@ def build_solver(goals: List[Goal] = []):
         ],
     }
     knowledge_base = KnowledgeBase.from_json(kb_dict)
-    solver = Solver(knowledge_base, SOLVER_MODE.forwards, goals=goals)
+    solver = Solver(knowledge_base, SOLVER_MODE.forwards, goals=goals, **kwargs)
     return solver
 
 
+def build_krl_solver(rules: str, goals: List[Goal] = [], defaults: Dict[str, str] = None, **kwargs) -> Solver:
+    """Solver for the rules in KRL over object ``obj`` with numeric attributes ``a``, ``b``, ``c``, ``w``, ``x``,
+    ``y`` and ``z``, ``defaults`` are KRL expressions of default values of the attributes."""
+    defaults = defaults or {}
+    attributes = "".join(
+        f"АТРИБУТ {name}\nТИП Число\nЗНАЧЕНИЕ\n{defaults[name]}\n"
+        if name in defaults
+        else f"АТРИБУТ {name}\nТИП Число\nКОММЕНТАРИЙ {name}\n"
+        for name in "abcwxyz"
+    )
+    krl = (
+        "ТИП Число\nЧИСЛО\nОТ -1000000000.0\nДО 1000000000.0\nКОММЕНТАРИЙ Число\n\n"
+        f"ОБЪЕКТ obj\nГРУППА obj\nАТРИБУТЫ\n{attributes}КОММЕНТАРИЙ obj\n\n{dedent(rules)}"
+    )
+    return Solver(KnowledgeBase.from_krl(krl), SOLVER_MODE.forwards, goals=goals, **kwargs)
+
+
 def test_forward():
     solver = build_solver()
     a1 = "object1.attr1"
@@ -280,3 +319,850 @@ def test_big_kb_solver(big_kb):
     solver = Solver(big_kb, mode=SOLVER_MODE.forwards, goals=[])
     assert len(solver.kb.rules) == 60
     solver.run_forward()
+
+
+def test_match_forward_tracks_wm_changes():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    assert [rule.id for rule in solver.match_forward()] == ["TEST_RULE1"]
+
+    solver.wm.set_value("object1.attr1", 1)
+    assert solver.match_forward() == []
+
+    solver.wm.set_value("object1.attr3", 7)
+    assert [rule.id for rule in solver.match_forward()] == ["TEST_RULE2"]
+
+
+def test_goal_tree_map_index():
+    solver = build_solver()
+    attr1 = KBReference.parse("object1.attr1")
+    attr3 = KBReference.parse("object1.attr3")
+    assert [rule.id for rule in solver.goal_tree.get_rules_reading_ref(attr1)] == ["TEST_RULE1"]
+    assert [rule.id for rule in solver.goal_tree.get_rules_assigning_ref(attr1)] == ["TEST_RULE2"]
+    assert [rule.id for rule in solver.goal_tree.get_rules_assigning_ref(attr3)] == ["TEST_RULE1"]
+    assert solver.goal_tree.get_rules_else_assigning_ref(attr3) == []
+
+
+def test_goal_registry():
+    solver = build_solver()
+    goal = solver.goal_tree.get_goal_by_ref(KBReference.parse("object1.attr3"))
+    assert goal is not None
+    assert solver.goal_tree.get_or_create_goal_by_ref(KBReference.parse("object1.attr3")) is goal
+    assert len(solver.goal_tree.all_goals) == 3
+
+
+def test_compiled_expressions_match_basic_evaluator():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    evaluator = BasicEvaluator(solver.wm)
+    for rule in solver.kb.world.rules:
+        expected = evaluator.eval(rule.condition)
+        assert solver.expressions.eval(rule.condition, solver.wm).content == expected.content
+        for instruction in rule.instructions:
+            expected = evaluator.eval(instruction.value)
+            assert solver.expressions.eval(instruction.value, solver.wm).content == expected.content
+
+
+def test_wm_reset_values():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("local_value", 1)
+    assert solver.wm.reset_values(["object1.attr1", "object1.attr2", "local_value"]) == [
+        "object1.attr1",
+        "local_value",
+    ]
+    value = solver.wm.get_value("object1.attr1")
+    assert value is None or value.content is None
+    assert solver.wm.get_value("local_value") is None
+
+
+def test_expressions_are_memoized_by_slot_versions():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    condition = solver.kb.world.rules[0].condition
+    first = solver.expressions.eval(condition, solver.wm)
+    assert solver.expressions.eval(condition, solver.wm) is first
+
+    version = solver.wm.get_version(solver.wm.get_slot_by_key("object1.attr1"))
+    solver.wm.set_value("object1.attr1", -1)
+    assert solver.wm.get_version(solver.wm.get_slot_by_key("object1.attr1")) > version
+    assert first.content is True
+    assert solver.expressions.eval(condition, solver.wm).content is False
+
+
+def test_logical_operations_are_three_valued():
+    solver = build_solver()
+    condition = solver.kb.world.rules[0].condition  # attr1 >= 0 and attr2 < ...
+    solver.wm.set_value("object1.attr1", -1)
+    assert BasicEvaluator(solver.wm).eval(condition).content is False
+    assert solver.expressions.eval(condition, solver.wm).content is False
+
+    solver.wm.set_value("object1.attr1", 1)
+    assert BasicEvaluator(solver.wm).eval(condition).content is None
+    assert solver.expressions.eval(condition, solver.wm).content is None
+
+
+def test_evaluation_results_are_copied_into_wm():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.run_forward()
+    value = solver.wm.get_value("object1.attr3")
+    assert value.non_factor is not SHARED_NON_FACTOR
+    assert unify_number(2.0) == 2 and isinstance(unify_number(2.0), int)
+    assert unify_number(2.5) == 2.5
+
+
+def test_find_cycles():
+    graph = {"a": ["b"], "b": ["c"], "c": ["a", "d"], "d": [], "e": ["e"]}
+    assert find_cycles(graph) == [["a", "b", "c"], ["e"]]
+
+
+def test_wm_rejects_recursive_links():
+    solver = build_solver()
+    assert solver.wm.value_cycles == []
+    solver.wm.set_value_by_ref(KBReference.parse("object1.attr1"), KBReference.parse("object1.attr2"))
+    with pytest.raises(ValueError):
+        solver.wm.set_value_by_ref(KBReference.parse("object1.attr2"), KBReference.parse("object1.attr1"))
+
+
+def test_recursive_local_values_are_rejected_on_evaluation():
+    solver = build_solver()
+    solver.wm.locals["local1"] = KBReference.parse("local2")
+    solver.wm.locals["local2"] = KBReference.parse("local1")
+    with pytest.raises(ValueError):
+        BasicEvaluator(solver.wm).eval(KBReference.parse("local1"))
+    with pytest.raises(ValueError):
+        solver.expressions.eval(KBReference.parse("local1"), solver.wm)
+    solver.wm.locals["local2"] = KBReference.parse("object1.attr1")
+    solver.wm.set_value("object1.attr1", 4)
+    assert solver.expressions.eval(KBReference.parse("local1"), solver.wm).content == 4
+
+
+def test_wm_defaults_are_evaluated_in_dependency_order():
+    rules = """
+        ПРАВИЛО R_y
+        ЕСЛИ
+            (obj.a) > (0)
+        ТО
+            obj.y = (5) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_y
+    """
+    defaults = {"x": "(obj.y) + (1)", "y": "2"}
+    solver = build_krl_solver(rules, goals=[Goal(KBReference.parse("obj.x"))], defaults=defaults)
+    assert solver.wm.value_cycles == []
+    assert solver.wm.get_value("obj.x").content == 3
+    assert solver.wm.get_value("obj.y").content == 2
+    # defaults are constants once evaluated, so they do not link properties
+    assert solver.relevant_rules == set()
+    solver.wm.set_value("obj.y", 7)
+    assert solver.matcher.get_affected_keys("obj.y") == {"obj.y"}
+    assert solver.wm.get_value("obj.x").content == 3
+
+
+def test_wm_reports_default_cycles():
+    solver = build_krl_solver("", defaults={"x": "(obj.y) + (1)", "y": "(obj.x) + (1)", "z": "(obj.x) + (1)"})
+    assert [sorted(cycle) for cycle in solver.wm.value_cycles] == [["obj.x", "obj.y"]]
+    for key in ["obj.x", "obj.y", "obj.z"]:
+        value = solver.wm.get_value(key)
+        assert value is None or value.content is None
+
+
+def test_non_factor_calculus():
+    calculus = NonFactorCalculus(logic=NON_FACTOR_LOGIC.product, combine=NON_FACTOR_COMBINE.noisy_or)
+    a = NonFactor(belief=50, probability=80, accuracy=0)
+    b = NonFactor(belief=40, probability=100, accuracy=1)
+    conjunction = calculus.conjunction(a, b)
+    assert (conjunction.belief, conjunction.probability, conjunction.accuracy) == (20, 80, 1)
+    disjunction = calculus.disjunction(a, b)
+    assert (disjunction.belief, disjunction.probability) == (70, 100)
+    assert calculus.identity(a) is a
+    true_and = calculus.logical("and", True, a, b)
+    assert (true_and.belief, true_and.probability) == (20, 80)
+    false_and = calculus.logical("and", False, a, b)
+    assert (false_and.belief, false_and.probability) == (70, 100)
+    false_or = calculus.logical("or", False, a, b)
+    assert (false_or.belief, false_or.probability) == (20, 80)
+    combined = calculus.combine(a, b)
+    assert (combined.belief, combined.probability) == (70, 100)
+
+
+def test_non_factors_are_propagated_to_assigned_values():
+    solver = build_solver(non_factors=NonFactorCalculus(logic=NON_FACTOR_LOGIC.min))
+    solver.wm.set_value("object1.attr1", KBValue(content=4, non_factor=NonFactor(belief=30, probability=90)))
+    solver.wm.set_value("object1.attr2", KBValue(content=2, non_factor=NonFactor(belief=60, probability=80)))
+    condition = solver.kb.world.rules[0].condition
+    evaluated = solver.expressions.eval(condition, solver.wm)
+    expected = BasicEvaluator(solver.wm, non_factors=solver.non_factors).eval(condition)
+    assert evaluated.content is True
+    assert evaluated.non_factor.belief == expected.non_factor.belief <= 30
+    assert evaluated.non_factor.probability == expected.non_factor.probability <= 80
+
+    solver.run_forward()
+    assert solver.wm.get_value("object1.attr3").non_factor.belief <= 30
+
+
+def test_equivalent_rules_conclude_equal_non_factors():
+    rules = """
+        ПРАВИЛО R_else
+        ЕСЛИ
+            (obj.a) > (5)
+        ТО
+            obj.x = (0) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        ИНАЧЕ
+            obj.y = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_else
+
+        ПРАВИЛО R_then
+        ЕСЛИ
+            (obj.a) <= (5)
+        ТО
+            obj.c = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_then
+
+        ПРАВИЛО R_or_else
+        ЕСЛИ
+            ((obj.a) > (5)) | ((obj.b) > (5))
+        ТО
+            obj.x = (0) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        ИНАЧЕ
+            obj.z = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_or_else
+
+        ПРАВИЛО R_and_then
+        ЕСЛИ
+            ((obj.a) <= (5)) & ((obj.b) <= (5))
+        ТО
+            obj.w = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_and_then
+    """
+    for logic in NON_FACTOR_LOGIC.all():
+        solver = build_krl_solver(rules, non_factors=NonFactorCalculus(logic=logic))
+        solver.wm.set_value("obj.a", KBValue(content=3, non_factor=NonFactor(belief=30, probability=90)))
+        solver.wm.set_value("obj.b", KBValue(content=4, non_factor=NonFactor(belief=60, probability=80)))
+        solver.run_forward()
+        for left, right in [("obj.y", "obj.c"), ("obj.z", "obj.w")]:
+            left_nf = solver.wm.get_value(left).non_factor
+            right_nf = solver.wm.get_value(right).non_factor
+            assert (left_nf.belief, left_nf.probability) == (right_nf.belief, right_nf.probability)
+
+
+def test_agenda_priority_strategy():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.wm.set_value("object1.attr3", 7)
+    assert [rule.id for rule in solver.match_forward()] == ["TEST_RULE1", "TEST_RULE2"]
+
+    solver.set_strategy(AGENDA_STRATEGY.priority, priorities={"TEST_RULE2": 10})
+    assert [rule.id for rule in solver.match_forward()] == ["TEST_RULE2", "TEST_RULE1"]
+
+
+def test_agenda_is_walked_lazily_in_order(big_kb):
+    goal_tree = Solver(big_kb, mode=SOLVER_MODE.forwards, goals=[]).goal_tree
+    priorities = {rule.id: ordinal % 7 for ordinal, rule in enumerate(goal_tree.rules)}
+    agenda = Agenda(goal_tree, strategy=AGENDA_STRATEGY.priority, priorities=priorities)
+    for ordinal in range(len(goal_tree.rules)):
+        agenda.activate(ordinal)
+    for ordinal in range(0, len(goal_tree.rules), 3):
+        agenda.deactivate(ordinal)
+    for ordinal in range(0, len(goal_tree.rules), 6):
+        agenda.activate(ordinal)
+    active = [ordinal for ordinal in range(len(goal_tree.rules)) if agenda.is_active(ordinal)]
+    expected = sorted(active, key=agenda.order_key)
+    assert list(agenda.ordered()) == expected
+    assert next(agenda.ordered()) == expected[0]
+
+
+def test_agenda_recency_survives_strategy_change():
+    solver = build_solver(strategy=AGENDA_STRATEGY.recency)
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.wm.set_value("object1.attr3", 7)
+    assert [rule.id for rule in solver.match_forward()] == ["TEST_RULE2", "TEST_RULE1"]
+    solver.set_strategy(AGENDA_STRATEGY.recency)
+    assert [rule.id for rule in solver.match_forward()] == ["TEST_RULE2", "TEST_RULE1"]
+
+
+def test_fired_rules_per_step():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.run_forward()
+    assert [[rule.id for rule in step.fired_rules] for step in solver.trace.steps] == [
+        ["TEST_RULE1"],
+        ["TEST_RULE1", "TEST_RULE2"],
+    ]
+    assert solver.trace.steps[-1].selected_rule in solver.fired_rules
+
+
+def test_trace_states_are_rebuilt_from_changes():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.run_forward()
+    first, second = solver.trace.steps
+    assert first.initial_wm_state.get_value("object1.attr1").content == 4
+    assert first.final_wm_state.get_value("object1.attr3").content == 6
+    assert second.initial_wm_state.get_value("object1.attr1").content == 4
+    assert second.final_wm_state.get_value("object1.attr1").content == 0
+    assert [change.new.content for change in second.changes] == [0, 0]
+
+
+def test_trace_states_are_replayed_from_checkpoints():
+    solver = build_solver()
+    solver.start()
+    positions = []
+    for value in range(3 * CHECKPOINT_INTERVAL):
+        solver.wm.set_value("object1.attr1", value)
+        if value == CHECKPOINT_INTERVAL:
+            solver.wm = solver.wm.fork()
+        positions.append((solver.trace.position(solver.wm), value))
+    for position, value in positions[::-1] + positions:
+        assert solver.trace.state_at(position).get_value("object1.attr1").content == value
+
+
+def test_trace_does_not_journal_updates_between_runs():
+    for level in [TRACE_LEVEL.full, TRACE_LEVEL.summary]:
+        solver = build_solver()
+        solver.wm.set_value("object1.attr1", 4)
+        solver.wm.set_value("object1.attr2", 2)
+        solver.run_forward(trace_level=level)
+        changes = solver.trace.changes_between(0, sys.maxsize)
+        for value in range(100):
+            solver.wm.set_value("object1.attr2", value)
+        assert solver.trace.changes_between(0, sys.maxsize) == changes
+
+
+def test_trace_levels():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.run_forward(trace_level=TRACE_LEVEL.off)
+    assert solver.trace.__dict__ == {"steps": []}
+    assert solver.wm.get_value("object1.attr1").content == 0
+
+    solver.wm.set_value("object1.attr1", 4)
+    solver.wm.set_value("object1.attr2", 2)
+    solver.run_forward(trace_level=TRACE_LEVEL.summary)
+    steps = solver.trace.__dict__["steps"]
+    assert [step["selected_rule"] for step in steps] == ["TEST_RULE1", "TEST_RULE2"]
+    assert steps[0]["changes"] == ["object1.attr3"]
+    assert "final_wm_state" not in steps[0]
+
+
+def test_wm_slots():
+    solver = build_solver()
+    slot = solver.wm.get_slot(KBReference.parse("object1.attr2"))
+    assert slot is not None
+    assert solver.wm.get_slot(KBReference.parse("object1.unknown")) is None
+    assert solver.wm.get_instance_by_key("object1.attr2").id == "attr2"
+
+
+def test_wm_prototype_instances_are_independent(big_kb):
+    first = WorkingMemory(kb=big_kb)
+    second = WorkingMemory(kb=big_kb)
+    assert first.all_values_dict == second.all_values_dict
+    key = first.slot_keys[0]
+    assert first.get_instance_by_key(key) is not second.get_instance_by_key(key)
+
+
+def test_wm_fork_is_copy_on_write():
+    solver = build_solver()
+    solver.wm.set_value("object1.attr1", 4)
+    fork = solver.wm.fork()
+    fork.set_value("object1.attr1", 5)
+    fork.set_value("local_value", 1)
+    assert solver.wm.get_value("object1.attr1").content == 4
+    assert fork.get_value("object1.attr1").content == 5
+    assert solver.wm.get_value("local_value") is None
+
+    solver.wm.set_value("object1.attr2", 3)
+    assert fork.get_value("object1.attr2") is None or fork.get_value("object1.attr2").content is None
+    assert solver.wm.env.properties[0].properties[1].value.content == 3
+
+
+def test_wm_fork_keeps_versions_with_values():
+    solver = build_solver()
+    wm = solver.wm
+    slot = wm.get_slot_by_key("object1.attr1")
+    other = wm.get_slot_by_key("object1.attr2")
+    wm.set_value("object1.attr1", 4)
+    version = wm.get_version(slot)
+    fork = wm.fork()
+    assert fork.get_version(slot) == version
+    assert fork.get_versions(["object1.attr1", "object1.attr2"]) == wm.get_versions(["object1.attr1", "object1.attr2"])
+
+    fork.set_value("object1.attr2", 3)
+    assert fork._overlay is not wm._overlay
+    assert fork.get_version(slot) == version
+    assert fork.get_version(other) > version
+    assert wm.get_version(other) == 0
+
+    fork.set_value("object1.attr1", 5)
+    assert fork.get_version(slot) > fork.get_version(other)
+    assert wm.get_version(slot) == version
+    assert wm.get_value("object1.attr1").content == 4
+
+
+def test_wm_reference_cache():
+    solver = build_solver()
+    ref, key = solver.wm._prototype.references.resolve("object1.attr1")
+    assert key == "object1.attr1"
+    assert solver.wm.parse_reference("object1.attr1") is ref
+    assert solver.wm.reference_krl(ref) is solver.wm.reference_krl(ref)
+    solver.wm.set_value("object1.attr1", 4)
+    assert solver.wm.get_value("object1.attr1").content == 4
+
+
+def test_wm_update_values_applies_only_changes():
+    solver = build_solver()
+    changes = []
+    solver.wm.subscribe(changes.append)
+    assert solver.wm.update_values([WMUpdate("object1.attr1", 4), WMUpdate("object1.attr2", 3)]) == [
+        "object1.attr1",
+        "object1.attr2",
+    ]
+    assert solver.wm.update_values([WMUpdate("object1.attr1", 4), WMUpdate("object1.attr2", 5)]) == ["object1.attr2"]
+    assert len(changes) == 3
+
+    assert solver.wm.update_values([WMUpdate("object1.attr1", 4)], clear_before=True) == ["object1.attr2"]
+    assert solver.wm.get_value("object1.attr1").content == 4
+    assert solver.wm.get_value("object1.attr2") is WorkingMemory(kb=solver.kb).get_value("object1.attr2")
+
+
+def test_fuzzy_membership_and_defuzzification():
+    pytest.importorskip("numpy")
+    from at_solver.evaluations.fuzzy import FuzzyVariable
+    from at_solver.evaluations.fuzzy import MEMBERSHIP_FUNCTION
+    from at_solver.evaluations.fuzzy import read_membership_function
+
+    low = read_membership_function({"name": "low", "points": [(0, 0), (25, 1), (50, 0)]})
+    high = read_membership_function({"name": "high", "points": [(50, 0), (75, 1), (100, 0)]})
+    assert low.kind == MEMBERSHIP_FUNCTION.triangular
+    assert list(low([0, 12.5, 25, 50])) == [0.0, 0.5, 1.0, 0.0]
+
+    variable = FuzzyVariable("object1.attr1", [low, high], lower=0, upper=100)
+    assert abs(variable.defuzzify({"low": 1.0}) - 25) < 1e-6
+    assert abs(variable.defuzzify({"low": 0.5, "high": 0.5}) - 50) < 1e-6
+    assert variable.defuzzify({}) is None
+
+
+FUZZY_RULES = """
+    ПРАВИЛО R_low
+    ЕСЛИ
+        ((obj.x) = ("low")) & ((obj.a) > (0))
+    ТО
+        obj.y = ("low") УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_low
+
+    ПРАВИЛО R_high
+    ЕСЛИ
+        ((obj.x) = ("high")) | ((obj.a) > (5))
+    ТО
+        obj.y = ("high") УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_high
+"""
+
+
+def build_fuzzy_model():
+    from at_solver.evaluations.fuzzy import FuzzyModel
+    from at_solver.evaluations.fuzzy import FuzzyVariable
+    from at_solver.evaluations.fuzzy import read_membership_function
+
+    low = read_membership_function({"name": "low", "points": [(0, 0), (25, 1), (50, 0)]})
+    high = read_membership_function({"name": "high", "points": [(50, 0), (75, 1), (100, 0)]})
+    return FuzzyModel([FuzzyVariable(key, [low, high], lower=0, upper=100) for key in ["obj.x", "obj.y"]])
+
+
+def test_fuzzy_model_fuzzify():
+    pytest.importorskip("numpy")
+    model = build_fuzzy_model()
+    solver = build_krl_solver(FUZZY_RULES)
+    assert model.fuzzify(solver.wm)["obj.x"] == {}
+    solver.wm.set_value("obj.x", 40)
+    degrees = model.fuzzify(solver.wm)
+    assert degrees["obj.x"] == pytest.approx({"low": 0.4, "high": 0.0})
+    assert model.fuzzify(solver.wm) is degrees
+    solver.wm.set_value("obj.x", 60)
+    assert model.fuzzify(solver.wm)["obj.x"] == pytest.approx({"low": 0.0, "high": 0.4})
+
+
+def test_fuzzy_term_degrees_are_compiled_as_evaluated():
+    pytest.importorskip("numpy")
+    from at_solver.evaluations.fuzzy import FuzzyEvaluator
+    from at_solver.evaluations.fuzzy import FuzzyExpressions
+
+    solver = build_krl_solver(FUZZY_RULES, evaluator=SOLVER_EVALUATOR.fuzzy)
+    assert isinstance(solver.expressions, FuzzyExpressions)
+    model = build_fuzzy_model()
+    expressions = FuzzyExpressions(model)
+    expressions.compile_rules(solver.goal_tree.rules)
+    solver.wm.set_value("obj.a", 1)
+    for x, expected in [(40, [0.4, 0.0]), (60, [0.0, 0.4])]:
+        solver.wm.set_value("obj.x", x)
+        for rule, degree in zip(solver.goal_tree.rules, expected):
+            assert FuzzyEvaluator(solver.wm, model=model).eval(rule.condition).content == pytest.approx(degree)
+            value = expressions.eval(rule.condition, solver.wm)
+            assert value.content == pytest.approx(degree)
+            assert expressions.eval(rule.condition, solver.wm) is value
+
+
+def test_fuzzy_conclusions_are_aggregated():
+    pytest.importorskip("numpy")
+    from at_solver.evaluations.fuzzy import FuzzyExpressions
+
+    solver = build_krl_solver(FUZZY_RULES, evaluator=SOLVER_EVALUATOR.fuzzy)
+    solver.expressions = FuzzyExpressions(build_fuzzy_model())
+    low, high = [rule.instructions[0] for rule in solver.goal_tree.rules]
+    value = solver.conclude_fuzzy(low, KBValue(content="low"), KBValue(content=0.8))
+    assert value.content == pytest.approx(25, abs=0.5)
+    value = solver.conclude_fuzzy(high, KBValue(content="high"), KBValue(content=0.8))
+    assert value.content == pytest.approx(50, abs=0.5)
+    value = solver.conclude_fuzzy(low, KBValue(content="low"), KBValue(content=0.3))
+    assert value.content == pytest.approx(50, abs=0.5)
+    assert solver.fuzzy_conclusions == {"obj.y": {"low": 0.8, "high": 0.8}}
+
+
+FUZZY_KB = """
+    ТИП Число
+    ЧИСЛО
+    ОТ 0.0
+    ДО 100.0
+    КОММЕНТАРИЙ Число
+
+    ТИП Уровень
+    НЕЧЕТКИЙ
+    2
+    "low" 0 100 3 ={0|0; 25|1; 50|0}
+    "high" 0 100 3 ={50|0; 75|1; 100|0}
+    КОММЕНТАРИЙ Уровень
+
+    ОБЪЕКТ obj
+    ГРУППА obj
+    АТРИБУТЫ
+    АТРИБУТ t
+    ТИП Уровень
+    КОММЕНТАРИЙ t
+    АТРИБУТ u
+    ТИП Уровень
+    КОММЕНТАРИЙ u
+    КОММЕНТАРИЙ obj
+
+    ПРАВИЛО R_low
+    ЕСЛИ
+        (obj.t) = ("low")
+    ТО
+        obj.u = ("high") УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_low
+
+    ПРАВИЛО R_high
+    ЕСЛИ
+        (obj.t) = ("high")
+    ТО
+        obj.u = ("low") УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_high
+"""
+
+
+def test_fuzzy_solver_runs_forward_over_kb_fuzzy_types():
+    pytest.importorskip("numpy")
+    kb = KnowledgeBase.from_krl(dedent(FUZZY_KB))
+    solver = Solver(kb, SOLVER_MODE.forwards, goals=[], evaluator=SOLVER_EVALUATOR.fuzzy)
+    variables = solver.expressions.model.variables
+    assert sorted(variables) == ["obj.t", "obj.u"]
+    assert [mf.name for mf in variables["obj.t"].terms] == ["low", "high"]
+    assert variables["obj.t"].universe[0] == 0 and variables["obj.t"].universe[-1] == 100
+
+    solver.wm.set_value("obj.t", 40)
+    solver.run_forward()
+    assert [rule.id for rule in solver.fired_rules] == ["R_low"]
+    assert solver.fuzzy_conclusions == {"obj.u": {"high": pytest.approx(0.4)}}
+    assert solver.wm.get_value("obj.u").content == pytest.approx(75, abs=0.5)
+
+    with pytest.raises(ValueError):
+        Solver(kb, SOLVER_MODE.forwards, goals=[], evaluator=SOLVER_EVALUATOR.fuzzy, non_factors=NonFactorCalculus())
+
+
+def test_goal_closure_matches_recursive_search(big_kb):
+    solver = Solver(big_kb, mode=SOLVER_MODE.backwards, goals=[])
+
+    def can_reach(goal, rule_ids, watched):
+        watched.append(goal)
+        if any(rule.id in rule_ids for rule in solver.goal_tree.get_rules_assigning_ref(goal.ref)):
+            return True
+        return any(sg not in watched and can_reach(sg, rule_ids, watched) for sg in goal.subgoals)
+
+    def best_subgoal(goal, current_best, watched):
+        watched.append(goal)
+        if solver.goal_is_reached(goal):
+            return current_best
+        current_best = current_best or goal
+        if goal.subgoals:
+            for sg in goal.subgoals:
+                if sg not in watched:
+                    current_best = best_subgoal(sg, current_best, watched)
+        elif len(current_best.pregoals) < len(goal.pregoals):
+            return goal
+        return current_best
+
+    rules = solver.goal_tree.rules[::3]
+    for goal in list(solver.goal_tree.all_goals):
+        assert solver.can_reach_goal_by_rules(goal, rules) == can_reach(goal, {rule.id for rule in rules}, [])
+        assert goal.get_best_subgoal(solver) is best_subgoal(goal, None, [])
+
+
+def test_async_backward_prefetches_leaf_subgoals():
+    goal = Goal(KBReference.parse("object1.attr3"))
+    solver = build_solver(goals=[goal], prefetch_concurrency=2)
+    solver.mode = SOLVER_MODE.backwards
+    requested = []
+
+    async def request_value(ref: str):
+        requested.append(ref)
+        await asyncio.sleep(0)
+        solver.wm.set_value(ref, {"object1.attr1": 4, "object1.attr2": 2}[ref])
+
+    solver.on_request_value = request_value
+    asyncio.run(solver.run())
+    assert sorted(requested) == ["object1.attr1", "object1.attr2"]
+    assert solver.wm.get_value("object1.attr3").content is not None
+
+
+def test_async_backward_prefetches_only_leaves_of_rules_reading_the_best_subgoal():
+    rules = """
+        ПРАВИЛО R_ab
+        ЕСЛИ
+            ((obj.a) > (0)) & ((obj.b) > (0))
+        ТО
+            obj.x = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_ab
+
+        ПРАВИЛО R_c
+        ЕСЛИ
+            (obj.c) > (0)
+        ТО
+            obj.x = (2) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_c
+    """
+    goal = Goal(KBReference.parse("obj.x"))
+    solver = build_krl_solver(rules, goals=[goal], prefetch_concurrency=3)
+    solver.mode = SOLVER_MODE.backwards
+    best = solver.goal_tree.get_goal_by_ref(goal.ref).get_best_subgoal(solver)
+    expected = ["obj.c"] if best.ref.krl == "obj.c" else ["obj.a", "obj.b"]
+    requested = []
+
+    async def request_value(ref: str):
+        requested.append(ref)
+        await asyncio.sleep(0)
+        solver.wm.set_value(ref, 1)
+
+    solver.on_request_value = request_value
+    asyncio.run(solver.run())
+    assert sorted(requested) == expected
+    assert solver.wm.get_value("obj.x").content is not None
+
+
+def test_forward_matching_is_restricted_to_goal_slice(big_kb):
+    solver = Solver(big_kb, mode=SOLVER_MODE.forwards, goals=[])
+    goal_tree = solver.goal_tree
+    goal = Goal(goal_tree.get_rule_instructions_references(goal_tree.rules[0])[0])
+    solver.set_goals([goal])
+
+    relevant = set()
+    refs = [solver.goals[0].ref]
+    watched = []
+    while refs:
+        ref = refs.pop()
+        watched.append(ref)
+        for rule in goal_tree.get_rules_assigning_ref(ref, include_else=True):
+            relevant.add(rule.id)
+            reads = goal_tree.get_rule_condition_references(rule)
+            for instruction in rule.instructions + (rule.else_instructions or []):
+                if isinstance(instruction, AssignInstruction):
+                    reads += goal_tree.get_evaluatable_references(instruction.value)
+            for read in reads:
+                if not any(goal_tree.check_references_equal(read, seen) for seen in watched + refs):
+                    refs.append(read)
+    assert {goal_tree.rules[ordinal].id for ordinal in solver.relevant_rules} == relevant
+
+    solver.run_forward()
+    assert all(rule.id in relevant for rule in solver.fired_rules)
+
+    solver.set_goal_slicing(False)
+    solver.reset_wm()
+    unsliced = Solver(big_kb, mode=SOLVER_MODE.forwards, goals=[])
+    assert [rule.id for rule in solver.match_forward()] == [rule.id for rule in unsliced.match_forward()]
+
+
+def test_matcher_follows_value_links():
+    rules = """
+        ПРАВИЛО R_z
+        ЕСЛИ
+            (obj.y) > (0)
+        ТО
+            obj.z = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_z
+    """
+    solver = build_krl_solver(rules)
+    solver.wm.set_value_by_ref(KBReference.parse("obj.y"), KBReference.parse("obj.x"))
+    assert solver.match_forward() == []
+    assert solver.matcher.get_affected_keys("obj.x") == {"obj.x", "obj.y"}
+    solver.wm.set_value("obj.x", 1)
+    assert [rule.id for rule in solver.match_forward()] == ["R_z"]
+    solver.wm.set_value("obj.y", 0)
+    assert solver.matcher.get_affected_keys("obj.x") == {"obj.x"}
+    assert solver.match_forward() == []
+
+
+def test_goal_closure_is_rebuilt_for_new_goals():
+    rules = """
+        ПРАВИЛО R_x
+        ЕСЛИ
+            (obj.y) > (0)
+        ТО
+            obj.x = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_x
+
+        ПРАВИЛО R_y
+        ЕСЛИ
+            (obj.x) > (0)
+        ТО
+            obj.y = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_y
+    """
+    goal_tree = build_krl_solver(rules).goal_tree
+    # a closure built before the goals of the cycle are created
+    goal_tree.all_goals = []
+    goal_tree._goals_by_key = {}
+    goal_tree.build_closure()
+    x = goal_tree.get_or_create_goal_by_ref(KBReference.parse("obj.x"))
+    assert goal_tree.get_reachable_rules_bits(x) == 0b11
+    y = goal_tree.get_goal_by_ref(KBReference.parse("obj.y"))
+    assert goal_tree.get_reachable_rules_bits(y) == 0b11
+    assert goal_tree.can_reach_goal_by_rules(Goal(KBReference.parse("obj.a")), goal_tree.rules) is False
+
+
+def test_goal_slice_includes_rules_assigning_read_values():
+    rules = """
+        ПРАВИЛО R_x
+        ЕСЛИ
+            (obj.b) > (0)
+        ТО
+            obj.x = (obj.b) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_x
+
+        ПРАВИЛО R_y
+        ЕСЛИ
+            (obj.a) > (0)
+        ТО
+            obj.y = ((obj.x) + (1)) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_y
+
+        ПРАВИЛО R_c
+        ЕСЛИ
+            (obj.a) > (0)
+        ТО
+            obj.c = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+        КОММЕНТАРИЙ R_c
+    """
+    solver = build_krl_solver(rules, goals=[Goal(KBReference.parse("obj.y"))])
+    assert solver.relevant_rules == {0, 1}
+    solver.wm.set_value("obj.a", 1)
+    solver.wm.set_value("obj.b", 2)
+    solver.run_forward()
+    assert [rule.id for rule in solver.fired_rules] == ["R_x", "R_y"]
+    assert solver.wm.get_value("obj.y").content == 3
+
+
+def test_ordered_components():
+    graph = {0: [1], 1: [2], 2: [1], 3: [0], 4: []}
+    assert ordered_components(graph) == [[3], [0], [1, 2], [4]]
+    assert ordered_components(graph, key=lambda node: -node) == [[4], [3], [0], [2, 1]]
+
+
+def test_rule_strata_are_topologically_ordered(big_kb):
+    solver = Solver(big_kb, mode=SOLVER_MODE.forwards, goals=[])
+    strata = solver.strata
+    position = {ordinal: number for number, component in enumerate(strata.components) for ordinal in component}
+    assert sorted(position) == list(range(len(solver.goal_tree.rules)))
+    for writer, readers in strata.graph.items():
+        for reader in readers:
+            assert position[writer] < position[reader] or (
+                position[writer] == position[reader] and strata.is_cyclic(position[reader])
+            )
+
+
+def test_stratified_forward_of_cyclic_rules_matches_iterative():
+    results = []
+    for stratified in [False, True]:
+        solver = build_solver(stratified=stratified)
+        solver.wm.set_value("object1.attr1", 4)
+        solver.wm.set_value("object1.attr2", 2)
+        solver.run_forward()
+        results.append(([rule.id for rule in solver.fired_rules], solver.wm.all_values_dict))
+    assert not build_solver().strata.is_acyclic
+    assert results[0] == results[1]
+
+
+ACYCLIC_RULES = """
+    ПРАВИЛО R_x
+    ЕСЛИ
+        (obj.a) > (0)
+    ТО
+        obj.x = ((obj.a) + (1)) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_x
+
+    ПРАВИЛО R_y
+    ЕСЛИ
+        (obj.x) > (1)
+    ТО
+        obj.y = ((obj.x) * (2)) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_y
+
+    ПРАВИЛО R_c
+    ЕСЛИ
+        (obj.b) > (0)
+    ТО
+        obj.c = (obj.b) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_c
+
+    ПРАВИЛО R_z
+    ЕСЛИ
+        ((obj.y) > (2)) & ((obj.c) > (0))
+    ТО
+        obj.z = ((obj.y) + (obj.c)) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_z
+
+    ПРАВИЛО R_w
+    ЕСЛИ
+        (obj.a) > (100)
+    ТО
+        obj.w = (1) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    ИНАЧЕ
+        obj.w = (0) УВЕРЕННОСТЬ [50; 100] ТОЧНОСТЬ 0
+    КОММЕНТАРИЙ R_w
+"""
+
+
+def test_stratified_forward_of_acyclic_rules_matches_first_strategy():
+    runs = []
+    for stratified in [False, True]:
+        solver = build_krl_solver(ACYCLIC_RULES, strategy=AGENDA_STRATEGY.first, stratified=stratified)
+        solver.wm.set_value("obj.a", 1)
+        solver.wm.set_value("obj.b", 2)
+        trace = solver.run_forward()
+        steps = []
+        for step in trace.steps:
+            step_dict = step.__dict__
+            # conflict sets of stratified steps only hold the rules of the current stratum
+            step_dict.pop("conflict_rules")
+            steps.append(step_dict)
+        runs.append(([rule.id for rule in solver.fired_rules], solver.wm.all_values_dict, steps))
+    assert solver.strata.is_acyclic
+    assert runs[0][0] == ["R_x", "R_y", "R_c", "R_z", "R_w"]
+    assert runs[0] == runs[1]
+    assert solver.wm.get_value("obj.z").content == 6